@@ -5,18 +5,29 @@ import os
 import json
 import logging
 import re
+import asyncio
+import math
+import time
+from collections import deque
 import requests
-from report import Report
+from report import Report, State
 from modelPredict import Predictor
+from modelBatcher import BatchPredictor
+from modelServer import RemotePredictor
+from dispatcher import Dispatcher, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from casestore import CaseStore, CaseMessage, AlertCase, CASE_DB
 import pdb
 
 
 # Set up logging to the console
 logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
+# With PREDICTOR_EXECUTOR=process the pool's workers import this file too, so only the bot itself
+# opens (and truncates) the log and connects to Discord
+if __name__ == '__main__':
+    logger.setLevel(logging.DEBUG)
+    handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+    logger.addHandler(handler)
 
 # There should be a file called 'tokens.json' inside the same folder as this file
 token_path = 'tokens.json'
@@ -28,6 +39,11 @@ with open(token_path) as f:
     discord_token = tokens['discord']
 
 
+# Predictor settings that are the server's business when PREDICTOR_SOCKET is set (see modelServer.py --help)
+SERVER_OPTIONS = ['PREDICTOR_ENCODER', 'PREDICTOR_HEAD', 'PREDICTOR_BUNDLE', 'PREDICTOR_CASCADE', 'PREDICTOR_LONG_TEXT',
+                  'PREDICTOR_NEAR_DUP', 'TEMPLATE_THRESHOLD', 'PREDICTOR_EXACT_MATCH']
+
+
 class ModBot(discord.Client):
     def __init__(self): 
         intents = discord.Intents.default()
@@ -36,8 +52,187 @@ class ModBot(discord.Client):
         self.group_num = None
         self.mod_channels = {} # Map from guild to the mod channel id for that guild
         self.reports = {} # Map from user IDs to the state of their report
-        self.predictor = Predictor()
-        self.concerns = {}
+        # The models are loaded in the background (see load_models) so the bot can connect right away.
+        # Until they're ready, channel messages wait in a bounded buffer; the oldest are dropped if it fills up.
+        self.predictor = None
+        self.batcher = None
+        self.model_ready = False
+        self.pending_messages = deque(maxlen=int(os.environ.get('PENDING_MESSAGE_LIMIT', '1000')))
+        self.dropped_messages = 0
+        self.reloading = False
+        # All outgoing messages are queued per channel, high risk first (see dispatcher.py)
+        self.outbox = Dispatcher()
+        # Mod-channel alerts we posted, so reactions resolve without fetching or searching:
+        # alert message ID -> AlertCase, and flagged message ID -> alert IDs
+        self.alert_cases = {}
+        self.case_alerts = {}
+        # Open cases, alerts and concerns are kept in SQLite (see casestore.py) and survive restarts
+        self.store = CaseStore(os.environ.get('CASE_DB', CASE_DB))
+        self.case_max_age = float(os.environ.get('CASE_MAX_AGE_DAYS', '14'))
+        self.recover_cases()
+
+    def recover_cases(self):
+        reports, alerts = self.store.load(self.case_max_age)
+        for key, (message, danger, awaiting_mod) in reports.items():
+            report = Report(self)
+            report.message = message
+            report.danger = danger
+            report.awaiting_mod = awaiting_mod
+            if awaiting_mod:
+                report.state = State.REPORT_COMPLETE
+            self.reports[key] = report
+        for alert_id, case in alerts.items():
+            self.alert_cases[alert_id] = case
+            self.case_alerts.setdefault(case.message_id, []).append(alert_id)
+        logger.info(f'Recovered {len(reports)} open cases and {len(alerts)} alerts from {self.store.path}')
+
+    async def close(self):
+        await self.outbox.close()
+        await asyncio.to_thread(self.store.close)
+        await super().close()
+
+    async def setup_hook(self):
+        self.loop.create_task(self.load_models())
+        self.loop.create_task(self.expire_cases())
+
+    async def expire_cases(self, interval=None):
+        # Cases and alerts nobody acted on within CASE_MAX_AGE_DAYS are dropped while the bot runs, not just at startup
+        interval = interval or float(os.environ.get('CASE_EXPIRE_INTERVAL', '3600'))
+        while True:
+            await asyncio.sleep(interval)
+            report_keys, alert_ids = self.store.expire(self.case_max_age)
+            for key in report_keys:
+                self.reports.pop(key, None)
+            for alert_id in alert_ids:
+                case = self.alert_cases.pop(alert_id, None)
+                if case is not None and alert_id in self.case_alerts.get(case.message_id, []):
+                    self.case_alerts[case.message_id].remove(alert_id)
+                    if not self.case_alerts[case.message_id]:
+                        del self.case_alerts[case.message_id]
+            if report_keys or alert_ids:
+                logger.info(f'Expired {len(report_keys)} cases and {len(alert_ids)} alerts older than {self.case_max_age:g} days')
+
+    def build_predictor(self):
+        # Inference runs in a pool so it never blocks the gateway; PREDICTOR_EXECUTOR can be "thread" or "process"
+        return Predictor(executor=os.environ.get('PREDICTOR_EXECUTOR', 'thread'),
+                         max_workers=int(os.environ.get('PREDICTOR_WORKERS', '1')),
+                         encoder=os.environ.get('PREDICTOR_ENCODER', 'torch'),
+                         head=os.environ.get('PREDICTOR_HEAD', 'sklearn'),
+                         cascade=os.environ.get('PREDICTOR_CASCADE', '0') == '1',
+                         cascade_margin=float(os.environ.get('CASCADE_MARGIN', '0.3')),
+                         cascade_audit=float(os.environ.get('CASCADE_AUDIT', '0.0')),
+                         bundle=os.environ.get('PREDICTOR_BUNDLE'),
+                         long_text=os.environ.get('PREDICTOR_LONG_TEXT', '0') == '1',
+                         max_windows=int(os.environ.get('PREDICTOR_MAX_WINDOWS', '8')),
+                         near_dup=os.environ.get('PREDICTOR_NEAR_DUP', '0') == '1',
+                         near_dup_threshold=float(os.environ.get('NEAR_DUP_THRESHOLD', '0.8')),
+                         template_threshold=float(os.environ['TEMPLATE_THRESHOLD']) if os.environ.get('TEMPLATE_THRESHOLD') else None,
+                         exact_match=os.environ.get('PREDICTOR_EXACT_MATCH', '0') == '1')
+
+    async def load_models(self):
+        start = time.perf_counter()
+        # Retries with backoff (up to MODEL_RETRY_MAX seconds apart) while messages keep being buffered,
+        # and tells the moderators, since nothing gets classified until it works
+        retry_max = float(os.environ.get('MODEL_RETRY_MAX', '300'))
+        delay, attempts = min(5, retry_max), 0
+        while True:
+            attempts += 1
+            try:
+                if os.environ.get('PREDICTOR_SOCKET'):
+                    # Use the shared modelServer.py process, falling back to a local model if it's down
+                    ignored = [name for name in SERVER_OPTIONS if os.environ.get(name)]
+                    if ignored:
+                        logger.warning(f'{", ".join(ignored)} only apply to the local fallback model with PREDICTOR_SOCKET set; '
+                                       f'pass the matching modelServer.py flags to the server')
+                    self.predictor = RemotePredictor(os.environ['PREDICTOR_SOCKET'], make_local=self.build_predictor)
+                else:
+                    predictor = await asyncio.to_thread(self.build_predictor)
+                    try:
+                        # with PREDICTOR_EXECUTOR=process the models are only loaded here, in the pool's workers
+                        await predictor.awarmUp()
+                    except BaseException:
+                        predictor.close()
+                        raise
+                    self.predictor = predictor
+                break
+            except Exception as e:
+                logger.exception(f'Failed to load the classification models (attempt {attempts}), retrying in {delay}s')
+                for channel in self.mod_channels.values():
+                    self.outbox.send(channel, f'Loading the classification models failed ({e}), retrying in {delay}s. '
+                                              f'Channel messages are held until it works.', PRIORITY_HIGH)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, retry_max)
+        if attempts > 1:
+            for channel in self.mod_channels.values():
+                self.outbox.send(channel, f'Classification models loaded after {attempts} attempts.', PRIORITY_HIGH)
+        # Concurrent channel messages are classified together in one encode call
+        self.batcher = BatchPredictor(self.predictor,
+                                      max_batch_size=int(os.environ.get('BATCH_MAX_SIZE', '32')),
+                                      max_wait=float(os.environ.get('BATCH_MAX_WAIT_MS', '5')) / 1000)
+        logger.info(f'Models loaded in {time.perf_counter() - start:.1f}s, '
+                    f'classifying {len(self.pending_messages)} buffered messages ({self.dropped_messages} dropped)')
+
+        # Messages that arrive while we drain are buffered too, so everything is handled before going live
+        while self.pending_messages:
+            buffered = list(self.pending_messages)
+            self.pending_messages.clear()
+            results = await asyncio.gather(*(self.classify_message(m) for m in buffered), return_exceptions=True)
+            for message, result in zip(buffered, results):
+                if isinstance(result, Exception):
+                    logger.error(f'Classifying buffered message {message.id} failed', exc_info=result)
+        self.model_ready = True
+        if os.environ.get('PREDICTOR_BUNDLE'):
+            self.loop.create_task(self.watch_model_bundle(os.environ['PREDICTOR_BUNDLE']))
+
+    async def reload_model(self, reason):
+        '''
+        Loads and warms up a new Predictor in the background, then swaps it in. Batches already running
+        finish on the old model, which is closed once it has no more work.
+        '''
+        if isinstance(self.predictor, RemotePredictor):
+            return 'Models are served by the inference server; restart it to reload.'
+        if self.reloading or self.predictor is None:
+            return 'The model is still loading, try again later.'
+        self.reloading = True
+        predictor = None
+        try:
+            start = time.perf_counter()
+            predictor = await asyncio.to_thread(self.build_predictor)
+            loaded = time.perf_counter() - start
+            # with PREDICTOR_EXECUTOR=process this starts the new pool and warms up its workers, not this process
+            warm_up = await predictor.awarmUp()
+            old, self.predictor = self.predictor, predictor
+            self.batcher.predictor = predictor
+            old.close()
+            summary = (f'Model reloaded ({reason}) in {time.perf_counter() - start:.1f}s (load {loaded:.1f}s), '
+                       f'warm-up: {warm_up["mean_ms"]:.1f} ms per {warm_up["messages"]} messages, '
+                       f'first call {warm_up["first_ms"]:.1f} ms')
+            logger.info(summary)
+            return summary
+        except Exception as e:
+            logger.exception('Model reload failed, keeping the current model')
+            if predictor is not None and predictor is not self.predictor:
+                predictor.close()
+            return f'Model reload failed, keeping the current model: {e}'
+        finally:
+            self.reloading = False
+
+    async def watch_model_bundle(self, path, interval=None):
+        # The bundle manifest is replaced last when a bundle is rebuilt, so its mtime changing means a new model
+        interval = interval or float(os.environ.get('MODEL_WATCH_INTERVAL', '10'))
+        manifest = os.path.join(path, 'manifest.json')
+        last = os.path.getmtime(manifest) if os.path.exists(manifest) else None
+        while True:
+            await asyncio.sleep(interval)
+            if not os.path.exists(manifest):
+                continue
+            mtime = os.path.getmtime(manifest)
+            if mtime != last:
+                # only a reload that swapped the model in counts, otherwise it's retried on the next tick
+                current = self.predictor
+                await self.reload_model(f'new bundle in {path}')
+                if self.predictor is not current:
+                    last = mtime
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
@@ -76,31 +271,54 @@ class ModBot(discord.Client):
     async def on_raw_reaction_add(self, payload):
         if payload.user_id == self.user.id:
             return
-        channel = self.get_channel(payload.channel_id)
-        if not channel:
+        if str(payload.emoji.name) != '❌' and str(payload.emoji.name) != '👎':
             return
-        if not channel.name == f'group-{self.group_num}-mod':
+        case = self.alert_cases.get(payload.message_id)
+        if case is None:
             return
-        
-        if self.get_guild(payload.guild_id):
-            if str(payload.emoji.name) != '❌' and str(payload.emoji.name) != '👎':
-                return
-            message = await channel.fetch_message(payload.message_id)
-            for author in self.reports:
-                report = self.reports[author]
-                if report.message.content in message.content:
-                    await report.message.delete()
-                    if str(payload.emoji.name) == '❌':
-                        await report.message.channel.send(f"{report.message.author} has been removed from this channel")
-                    self.reports.pop(author)
-                    break
+        self.resolve_case(case.message_id)
+        channel = self.get_channel(case.channel_id)
+        if channel is not None:
+            try:
+                await channel.get_partial_message(case.message_id).delete()
+            except discord.errors.NotFound:
+                pass
+            if str(payload.emoji.name) == '❌':
+                self.outbox.send(channel, f"{case.author_name} has been removed from this channel", PRIORITY_HIGH, merge=True)
+        report = self.reports.get(case.report_key)
+        if report is not None and report.message is not None and report.message.id == case.message_id:
+            self.close_report(case.report_key)
+
+    def post_alert(self, channel, content, priority, key, flagged):
+        # Sends a mod-channel alert about `flagged` and indexes it for on_raw_reaction_add once it's posted
+        case = AlertCase(key, flagged.channel.id, flagged.id, str(flagged.author))
+        def index(future):
+            for alert in future.result():
+                self.alert_cases[alert.id] = case
+                self.case_alerts.setdefault(flagged.id, []).append(alert.id)
+                self.store.put_alert(alert.id, case)
+        self.outbox.send(channel, content, priority).add_done_callback(index)
+
+    def resolve_case(self, message_id):
+        alert_ids = self.case_alerts.pop(message_id, [])
+        for alert_id in alert_ids:
+            self.alert_cases.pop(alert_id, None)
+        self.store.delete_alerts(message_id, alert_ids)
+
+    def open_report(self, key, report):
+        self.reports[key] = report
+        self.store.put_report(key, CaseMessage.from_discord(report.message), report.danger, report.awaiting_mod)
+
+    def close_report(self, key):
+        self.reports.pop(key, None)
+        self.store.delete_report(key)
 
     async def handle_dm(self, message):
         # Handle a help message
         if message.content == Report.HELP_KEYWORD:
             reply =  "Use the `report` command to begin the reporting process.\n"
             reply += "Use the `cancel` command to cancel the report process.\n"
-            await message.channel.send(reply)
+            self.outbox.send(message.channel, reply)
             return
 
         author_id = message.author.id
@@ -116,8 +334,8 @@ class ModBot(discord.Client):
 
         # Let the report class handle this message; forward all the messages it returns to us
         responses = await self.reports[author_id].handle_message(message)
-        for r in responses:
-            await message.channel.send(r)
+        if responses:
+            self.outbox.send(message.channel, "\n".join(responses))
 
         # If the report is complete or cancelled, remove it from our map
         if not self.reports[author_id].report_complete():
@@ -125,80 +343,111 @@ class ModBot(discord.Client):
         
         if not self.reports[author_id].awaiting_mod:
             if self.reports[author_id].send_to_mod:
-                await self.send_reported_message(self.reports[author_id])
+                await self.send_reported_message(self.reports[author_id], author_id)
 
-    async def send_reported_message(self, report):
+    async def send_reported_message(self, report, key):
+        # key is the reporting user's ID, which the report is stored under in self.reports
         message = report.message
         mod_channel = self.mod_channels[message.guild.id]
+        lines = []
         if report.danger == True:
-            await mod_channel.send('This message was flagged as causing imminent danger to the user or other parties. Please follow the proper protocols and contact local authorities.')
-        await mod_channel.send('If you would you like to remove this message, react with 👎')
-        await mod_channel.send('If you like to remove this message and ban the user, react with ❌:')
-        await mod_channel.send(message.content)
+            lines.append('This message was flagged as causing imminent danger to the user or other parties. Please follow the proper protocols and contact local authorities.')
+        lines.append('If you would you like to remove this message, react with 👎')
+        lines.append('If you like to remove this message and ban the user, react with ❌:')
+        lines.append(message.content)
+        self.post_alert(mod_channel, "\n".join(lines), PRIORITY_HIGH if report.danger else PRIORITY_NORMAL,
+                        key, message)
         report.awaiting_mod = True
+        self.open_report(key, report)
 
     async def handle_channel_message(self, message):
+        # Moderators can reload the model from the mod channel
+        if message.channel.name == f'group-{self.group_num}-mod' and message.content.strip() == '!reload':
+            self.outbox.send(message.channel, 'Reloading the model...', PRIORITY_LOW)
+            self.outbox.send(message.channel, await self.reload_model(f'requested by {message.author.name}'), PRIORITY_LOW)
+            return
+
         # Only handle messages sent in the "group-#" channel
         if not message.channel.name == f'group-{self.group_num}':
             return
 
+        if not self.model_ready:
+            if len(self.pending_messages) == self.pending_messages.maxlen:
+                self.dropped_messages += 1
+            self.pending_messages.append(message)
+            return
+        await self.classify_message(message)
+
+    async def classify_message(self, message):
         # Forward the message to the mod channel
         mod_channel = self.mod_channels[message.guild.id]
         # await mod_channel.send(f'Forwarded message:\n{message.author.name}: "{message.content}"')
-        classification = self.eval_text(message.content)[0]
-        result = await self.code_format(classification, message)
-        for msg in result:
-            await mod_channel.send(msg)
+        score = await self.eval_text(message.content)
+        result = await self.code_format(score.label, message, score)
+        # the whole alert goes out as one message; moderate risk alerts ask moderators to react
+        if score.label == 'moderate risk':
+            self.post_alert(mod_channel, "\n".join(result), PRIORITY_NORMAL, message.author.id, message)
+        elif result:
+            self.outbox.send(mod_channel, "\n".join(result), PRIORITY_HIGH if score.label == 'high risk' else PRIORITY_NORMAL)
 
     
-    def eval_text(self, message):
-        return self.predictor.svmPredict(message)
+    async def eval_text(self, message):
+        return await self.batcher.predict(message)
 
     
-    async def code_format(self, classification, msg):
+    def confidence_text(self, score):
+        # score is the MessageScore from the same model pass that produced the classification
+        if score is None:
+            return ""
+        # margins are in different units per source (see modelPredict.SOURCES), so each one says what it is
+        if score.source == 'exact':
+            return " (the message is a sentence from the training data)"
+        if score.source == 'template':
+            return f" (matched known phrasing \"{score.template}\", similarity margin {score.margin:.2f})"
+        model = 'keyword model' if score.source == 'tfidf' else 'model'
+        if not math.isnan(score.probability):
+            return f" ({model} confidence {score.probability:.0%}, margin {score.margin:.2f})"
+        return f" ({model} vote margin {score.margin:.2f})"
+
+    async def code_format(self, classification, msg, score=None):
         result = []
         name = (msg.author.name)[:-1]
         if classification == "no risk":
             result.append("-------------------------------------")
             return []
-        result.append(f"This message from '{name}' was evaluated to be " + classification + ".")
+        result.append(f"This message from '{name}' was evaluated to be " + classification + self.confidence_text(score) + ".")
         author_id = msg.author.id
 
         # If we don't currently have an active report for this user, add one
         if author_id not in self.reports:
-            self.reports[author_id] = Report(self)
-            self.reports[author_id].message = msg
+            report = Report(self)
+            report.message = msg
+            self.open_report(author_id, report)
 
         if classification == 'high risk':
             result.append(f'Message: "{msg.content}"')
             result.append('It was flagged as causing imminent danger to the user or other parties. Please follow the proper protocols and contact local authorities.')
             result.append('The message was removed and the user placed on a temporary ban.')
             await msg.delete()
-            await msg.channel.send(f"{name} has been placed on a temporary ban")
             safe_msg = ["I'm really sorry you're feeling this way.", "You're not alone, and there are people who care about you and want to help.", "If you're in immediate danger or need support, please reach out to a mental health professional or contact a crisis line in your area.", "For example, if you're in the U.S., you can call or text the 988 Suicide & Crisis Lifeline at 988 — it's free, confidential, and available 24/7."]
-            for sentence in safe_msg:
-                await msg.channel.send(sentence)
-            self.reports.pop(author_id)
+            self.outbox.send(msg.channel, "\n".join([f"{name} has been placed on a temporary ban"] + safe_msg), PRIORITY_HIGH, merge=True)
+            self.close_report(author_id)
         elif classification == 'moderate risk':
-            if msg.author.name not in self.concerns:
-                self.concerns[msg.author.name] = {}
-                self.concerns[msg.author.name]["counter"] = 0
-                self.concerns[msg.author.name]["messages"] = []
-            self.concerns[msg.author.name]["counter"] += 1
-            self.concerns[msg.author.name]["messages"].append(msg.content)
+            counter, messages = await self.store.add_concern(msg.author.name, msg.content)
             result.append('If you would you like to remove this message, react with 👎')
             result.append('If you like to remove this message and place this user on a temporary ban, react with ❌:')
             result.append(f'React to this message: "{msg.content}"')
-            if self.concerns[msg.author.name]["counter"] >= 3:
+            if counter >= 3:
                 result.append("-------------------------------------")
                 result.append(f"{name} has sent multiple messages consistent with moderate risk. Please review the following messages and escalate the concern if needed")
-                for i in range(len(self.concerns[msg.author.name]["messages"])):
-                    result.append(f'{i}. ' + '"' + self.concerns[msg.author.name]["messages"][i] + '"')
+                for i in range(len(messages)):
+                    result.append(f'{i}. ' + '"' + messages[i] + '"')
                 # result.append('If you like to remove this message and place this user on a temporary ban, react with ❌:')
                 # result.append(f'React to this message to place a ban on the user.')
         result.append("-------------------------------------")
         return result
 
 
-client = ModBot()
-client.run(discord_token)
\ No newline at end of file
+if __name__ == '__main__':
+    client = ModBot()
+    client.run(discord_token)
\ No newline at end of file
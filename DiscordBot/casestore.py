@@ -0,0 +1,239 @@
+# Persistent store for ModBot's open cases: flagged / reported messages waiting on moderators, the
+# mod-channel alerts that point at them, and the per-author moderate-risk concerns.
+# Everything lives in SQLite in WAL mode. The bot works from in-memory dicts (the hot tier) and every
+# change is queued and written in batches by a background thread, so the event loop never waits on disk;
+# the only reads after startup, concerns of authors missing from the hot tier, run in a thread.
+# On startup load() returns the cases that were open when the bot stopped, and expire() drops cases
+# nobody acted on for too long, so open cases don't pile up while the bot runs. It only needs a file path:
+#   store = CaseStore("/tmp/cases.db")
+#   await store.add_concern("someone", "a message")
+#   store.close()
+
+import asyncio
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+logger = logging.getLogger('discord')
+
+CASE_DB = "cases.db"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    key INTEGER PRIMARY KEY, message_id INTEGER, guild_id INTEGER, channel_id INTEGER, author_id INTEGER,
+    author_name TEXT, content TEXT, danger INTEGER, awaiting_mod INTEGER, updated REAL);
+CREATE INDEX IF NOT EXISTS reports_author ON reports(author_id);
+CREATE INDEX IF NOT EXISTS reports_message ON reports(message_id);
+CREATE TABLE IF NOT EXISTS alerts (
+    alert_id INTEGER PRIMARY KEY, report_key INTEGER, channel_id INTEGER, message_id INTEGER,
+    author_name TEXT, created REAL);
+CREATE INDEX IF NOT EXISTS alerts_message ON alerts(message_id);
+CREATE TABLE IF NOT EXISTS concerns (
+    author TEXT PRIMARY KEY, counter INTEGER, messages TEXT, updated REAL);
+"""
+
+
+class CaseMessage(NamedTuple):
+    # The parts of a flagged discord.Message a case needs, also what recovered reports hold as report.message
+    id: int
+    guild_id: int
+    channel_id: int
+    author_id: int
+    author_name: str
+    content: str
+
+    @classmethod
+    def from_discord(cls, message):
+        return cls(message.id, message.guild.id, message.channel.id, message.author.id, str(message.author), message.content)
+
+
+class AlertCase(NamedTuple):
+    report_key: int     # key of the case in ModBot.reports
+    channel_id: int     # channel of the flagged message
+    message_id: int     # the flagged message
+    author_name: str
+
+
+class CaseStore:
+    '''
+    Writes are fire-and-forget: they are applied in order, in batches of up to max_batch statements per
+    transaction, flush_interval seconds after the first one is queued. flush() waits for all of them.
+    Concerns are kept for the hot_concerns most recently active authors and read from disk on a miss;
+    each author keeps their last concern_history messages.
+    '''
+    def __init__(self, path=CASE_DB, flush_interval=0.2, max_batch=500, hot_concerns=10000, concern_history=20):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.hot_concerns = hot_concerns
+        self.concern_history = concern_history
+        self.concerns = OrderedDict()   # author -> (counter, messages), least recently active first
+        self.unwritten = {}             # author -> concern still queued, so an eviction can't lose it
+        self.lock = threading.Lock()
+        # last update of every open report / alert, oldest first, for expire()
+        self.report_times = OrderedDict()
+        self.alert_times = OrderedDict()
+        self.read_lock = threading.Lock()
+        self.reader = self._connect()
+        self.reader.executescript(SCHEMA)
+        self.writes = queue.Queue()
+        self.written = 0
+        self.failed = 0
+        self.writer = threading.Thread(target=self._write_loop, name="case-store", daemon=True)
+        self.writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.max_batch:
+                try:
+                    batch.append(self.writes.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            statements = [item for item in batch if item is not None]
+            try:
+                with conn:
+                    for sql, params, _ in statements:
+                        conn.execute(sql, params)
+                self.written += len(statements)
+                for _, _, done in statements:
+                    if done is not None:
+                        done()
+            except sqlite3.Error:
+                self.failed += len(statements)
+                logger.exception(f'Writing {len(statements)} case updates to {self.path} failed')
+            for _ in batch:
+                self.writes.task_done()
+            if batch[-1] is None:
+                conn.close()
+                return
+
+    def _write(self, sql, params, done=None):
+        # done is called on the writer thread once the statement is committed
+        self.writes.put((sql, params, done))
+
+    def load(self, max_age_days=14):
+        # (reports, alerts) still open, dropping cases nobody acted on in max_age_days
+        cutoff = time.time() - max_age_days * 86400
+        with self.read_lock, self.reader:
+            self.reader.execute("DELETE FROM reports WHERE updated < ?", (cutoff,))
+            self.reader.execute("DELETE FROM alerts WHERE created < ?", (cutoff,))
+        reports = {}
+        with self.read_lock:
+            for key, message_id, guild_id, channel_id, author_id, author_name, content, danger, awaiting_mod, updated in \
+                    self.reader.execute("SELECT key, message_id, guild_id, channel_id, author_id, author_name, content, "
+                                        "danger, awaiting_mod, updated FROM reports ORDER BY updated"):
+                reports[key] = (CaseMessage(message_id, guild_id, channel_id, author_id, author_name, content),
+                                bool(danger), bool(awaiting_mod))
+                self.report_times[key] = updated
+            alerts = {}
+            for alert_id, report_key, channel_id, message_id, author_name, created in \
+                    self.reader.execute("SELECT alert_id, report_key, channel_id, message_id, author_name, created "
+                                        "FROM alerts ORDER BY created"):
+                alerts[alert_id] = AlertCase(report_key, channel_id, message_id, author_name)
+                self.alert_times[alert_id] = created
+        return reports, alerts
+
+    def expire(self, max_age_days=14):
+        # (report keys, alert IDs) not updated in max_age_days; they are deleted here and the caller drops
+        # them from memory
+        cutoff = time.time() - max_age_days * 86400
+        expired = []
+        for times, table, column in ((self.report_times, "reports", "key"), (self.alert_times, "alerts", "alert_id")):
+            keys = []
+            while times and next(iter(times.values())) < cutoff:
+                keys.append(times.popitem(last=False)[0])
+            for key in keys:
+                self._write(f"DELETE FROM {table} WHERE {column} = ?", (key,))
+            expired.append(keys)
+        return tuple(expired)
+
+    def put_report(self, key, message, danger=False, awaiting_mod=False):
+        self._touch(self.report_times, key)
+        self._write("INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, message.id, message.guild_id, message.channel_id, message.author_id, message.author_name,
+                     message.content, int(danger), int(awaiting_mod), time.time()))
+
+    def delete_report(self, key):
+        self.report_times.pop(key, None)
+        self._write("DELETE FROM reports WHERE key = ?", (key,))
+
+    def put_alert(self, alert_id, case):
+        self._touch(self.alert_times, alert_id)
+        self._write("INSERT OR REPLACE INTO alerts VALUES (?, ?, ?, ?, ?, ?)",
+                    (alert_id, case.report_key, case.channel_id, case.message_id, case.author_name, time.time()))
+
+    def delete_alerts(self, message_id, alert_ids=()):
+        # all alerts about one flagged message; alert_ids are the ones the caller knows about
+        for alert_id in alert_ids:
+            self.alert_times.pop(alert_id, None)
+        self._write("DELETE FROM alerts WHERE message_id = ?", (message_id,))
+
+    def _touch(self, times, key):
+        times[key] = time.time()
+        times.move_to_end(key)
+
+    def _read_concern(self, author):
+        with self.lock:
+            value = self.unwritten.get(author)
+        if value is not None:
+            return value
+        with self.read_lock:
+            row = self.reader.execute("SELECT counter, messages FROM concerns WHERE author = ?", (author,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else (0, [])
+
+    async def concern(self, author):
+        # (counter, messages) for an author, (0, []) if they have none
+        if author not in self.concerns:
+            value = await asyncio.to_thread(self._read_concern, author)
+            # another message from the same author may have filled the hot tier while we were reading
+            if author not in self.concerns:
+                self._remember(author, value)
+        self.concerns.move_to_end(author)
+        return self.concerns[author]
+
+    async def add_concern(self, author, content):
+        counter, messages = await self.concern(author)
+        value = (counter + 1, (messages + [content])[-self.concern_history:])
+        self._remember(author, value)
+        with self.lock:
+            self.unwritten[author] = value
+        self._write("INSERT OR REPLACE INTO concerns VALUES (?, ?, ?, ?)",
+                    (author, value[0], json.dumps(value[1]), time.time()),
+                    lambda: self._concern_written(author, value))
+        return value
+
+    def _concern_written(self, author, value):
+        with self.lock:
+            if self.unwritten.get(author) is value:
+                del self.unwritten[author]
+
+    def _remember(self, author, value):
+        self.concerns[author] = value
+        self.concerns.move_to_end(author)
+        while len(self.concerns) > self.hot_concerns:
+            self.concerns.popitem(last=False)
+
+    def flush(self):
+        self.writes.join()
+
+    def close(self):
+        self.writes.put(None)
+        self.writer.join()
+        self.reader.close()
+
+    def stats(self):
+        return {"written": self.written, "failed": self.failed, "queued": self.writes.qsize(),
+                "hot_concerns": len(self.concerns)}
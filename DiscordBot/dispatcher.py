@@ -0,0 +1,166 @@
+# Outbound message queue for the bot. Every send goes into a per-channel priority queue that one task per
+# channel drains, so handlers don't wait on Discord and high-risk alerts go ahead of routine messages
+# when a channel is backed up. Each channel's task spends from a token bucket sized to Discord's
+# per-channel limit (5 messages / 5 s) to stay clear of 429s; discord.py still waits out any 429 we get.
+# A channel's queue and task only live while it has messages to send (and until its bucket has refilled,
+# so a new queue can't send a burst over the limit), so one-off DM channels don't accumulate.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+logger = logging.getLogger('discord')
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+MAX_MESSAGE_LENGTH = 2000
+
+
+def split_message(content, limit=MAX_MESSAGE_LENGTH):
+    # Splits on line breaks so every part fits in one Discord message
+    parts, current = [], ""
+    for line in content.split("\n"):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current or not parts:
+        parts.append(current)
+    return parts
+
+
+class TokenBucket:
+    def __init__(self, capacity=5, per=5.0):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def refill_time(self):
+        # seconds until the bucket is full again
+        tokens = min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+        return (self.capacity - tokens) / self.rate
+
+
+class ChannelQueue:
+    def __init__(self, channel, bucket):
+        self.channel = channel
+        self.bucket = bucket
+        self.heap = []  # (priority, sequence, content, merge, future)
+        self.ready = asyncio.Event()
+        self.task = None
+
+
+class Dispatcher:
+    '''
+    send() queues a message and returns a future for the list of discord.Messages that were posted (more
+    than one if it had to be split, empty if sending failed), so callers that need them, e.g. to index an
+    alert, can await it and everyone else can move on. Queued messages sent with merge=True are combined with other queued merge=True messages of the
+    same priority for the same channel, as long as they fit in one Discord message.
+    '''
+    def __init__(self, rate=5, per=5.0):
+        self.rate = rate
+        self.per = per
+        self.queues = {}    # channel id -> ChannelQueue
+        self.sequence = itertools.count()
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+        self.closing = False
+
+    def send(self, channel, content, priority=PRIORITY_NORMAL, merge=False):
+        queue = self.queues.get(channel.id)
+        if queue is None:
+            queue = self.queues[channel.id] = ChannelQueue(channel, TokenBucket(self.rate, self.per))
+        if queue.task is None or queue.task.done():
+            queue.task = asyncio.get_running_loop().create_task(self._drain(queue))
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(queue.heap, (priority, next(self.sequence), content, merge, future))
+        queue.ready.set()
+        return future
+
+    async def _drain(self, queue):
+        while True:
+            if not queue.heap:
+                queue.ready.clear()
+                idle = 0 if self.closing else queue.bucket.refill_time()
+                if idle > 0:
+                    try:
+                        await asyncio.wait_for(queue.ready.wait(), idle)
+                        continue
+                    except asyncio.TimeoutError:
+                        pass
+                if not queue.heap:
+                    # nothing can be queued between this check and the del, send() runs on the same loop
+                    del self.queues[queue.channel.id]
+                    return
+                continue
+            priority, _, content, merge, future = heapq.heappop(queue.heap)
+            futures = [future]
+            while merge and queue.heap and queue.heap[0][0] == priority and queue.heap[0][3] \
+                    and len(content) + 1 + len(queue.heap[0][2]) <= MAX_MESSAGE_LENGTH:
+                _, _, next_content, _, next_future = heapq.heappop(queue.heap)
+                content = content + "\n" + next_content
+                futures.append(next_future)
+            await self._post(queue, content, futures)
+
+    async def _post(self, queue, content, futures):
+        posted = []
+        try:
+            for part in split_message(content):
+                await queue.bucket.take()
+                posted.append(await queue.channel.send(part))
+                self.sent += 1
+        except Exception:
+            self.failed += 1
+            logger.exception(f'Sending to channel {queue.channel.id} failed')
+        finally:
+            # also when close() cancels us mid-send, so nobody waits on these forever
+            self.merged += len(futures) - 1
+            for future in futures:
+                if not future.done():
+                    future.set_result(posted)
+
+    async def close(self, timeout=10.0):
+        # Sends what's still queued for up to timeout seconds, then drops the rest
+        self.closing = True
+        for queue in self.queues.values():
+            queue.ready.set()
+        tasks = [queue.task for queue in self.queues.values() if queue.task is not None]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        dropped, cancelled = 0, []
+        for queue in list(self.queues.values()):
+            dropped += len(queue.heap)
+            queue.task.cancel()
+            cancelled.append(queue.task)
+            for _, _, _, _, future in queue.heap:
+                if not future.done():
+                    future.set_result([])
+        await asyncio.gather(*cancelled, return_exceptions=True)
+        if dropped:
+            logger.warning(f'Dropped {dropped} queued messages on shutdown')
+
+    def stats(self):
+        return {"sent": self.sent, "merged": self.merged, "failed": self.failed,
+                "queued": sum(len(queue.heap) for queue in self.queues.values())}
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+
+
+class BatchPredictor:
+    '''
+    Sits in front of a Predictor and coalesces concurrent channel messages into one
+    encode + one SVM scoring call. A batch is flushed once it reaches max_batch_size
+    or once the oldest message in it has waited max_wait seconds.
+    Up to max_concurrency batches are scored at once (default: the predictor's max_workers), so every
+    worker in the predictor's pool stays busy; while they all are, new messages wait for the next batch.
+    '''
+    def __init__(self, predictor, max_batch_size=32, max_wait=0.005, log_every=100, max_concurrency=None):
+        self.predictor = predictor
+        self.log_every = log_every
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency or getattr(predictor, "max_workers", 1)
+        self.queue = None
+        self.task = None
+        self.slots = None
+        self.flushing = set()
+
+        # stats used to tune max_batch_size / max_wait
+        self.batches = 0
+        self.messages = 0
+        self.batch_sizes = Counter()
+        self.total_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    def _ensure_started(self):
+        if self.task is None or self.task.done():
+            self.queue = asyncio.Queue()
+            self.slots = asyncio.Semaphore(self.max_concurrency)
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def predict(self, text):
+        # Returns the MessageScore (label, margin, probability) for a single message once its batch has been scored
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future, time.perf_counter()))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = loop.create_task(self._flush(batch))
+            self.flushing.add(task)
+            task.add_done_callback(self._flushed)
+
+    def _flushed(self, task):
+        self.flushing.discard(task)
+        self.slots.release()
+
+    async def _flush(self, batch):
+        texts = [text for text, _, _ in batch]
+        now = time.perf_counter()
+        for _, _, enqueued in batch:
+            wait = now - enqueued
+            self.total_wait += wait
+            self.max_queue_wait = max(self.max_queue_wait, wait)
+        self.batches += 1
+        self.messages += len(batch)
+        self.batch_sizes[len(batch)] += 1
+        if self.log_every and self.batches % self.log_every == 0:
+            logging.getLogger('discord').info(f'Batch predictor stats: {self.stats()}')
+
+        try:
+            scores = await self.predictor.ascore(texts)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), row in zip(batch, scores.rows()):
+            if not future.done():
+                future.set_result(row)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "mean_batch_size": self.messages / self.batches if self.batches else 0.0,
+            "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+            "mean_queue_wait_ms": 1000 * self.total_wait / self.messages if self.messages else 0.0,
+            "max_queue_wait_ms": 1000 * self.max_queue_wait,
+            "pending": self.queue.qsize() if self.queue is not None else 0,
+            "batches_in_flight": len(self.flushing),
+        }
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
@@ -0,0 +1,110 @@
+# Benchmarks Predictor backends on real sentences from FinalData.csv and writes the results as JSON.
+# Run from the DiscordBot directory:
+#   python modelBenchmark.py --backends simple svm --batch-sizes 1 8 32 --threads 1 4 --out bench.json
+# Latencies are per call (one batch), throughput is messages/sec over all threads. The result cache is
+# disabled so every call does the full work. DistilBERT's predict() only takes one message, so the
+# "bert" backend is only run with batch size 1.
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from modelPredict import DATA_PATH
+
+METHODS = {"simple": "simplePredict", "svm": "svmPredict", "bert": "predict"}
+
+
+def load_sentences(limit=5000, seed=0):
+    sentences = pd.read_csv(DATA_PATH, usecols=['sentence'])['sentence'].dropna().astype(str).tolist()
+    random.Random(seed).shuffle(sentences)
+    return sentences[:limit]
+
+
+def cold_start(backend, predictor_args):
+    # Fresh interpreter: imports + model loading + first prediction
+    code = ("import time; start = time.perf_counter(); import modelPredict; "
+            f"p = modelPredict.Predictor(backends=({backend!r},), cache_size=0, **{predictor_args!r}); "
+            "loaded = time.perf_counter(); "
+            f"p.{METHODS[backend]}({'I made pasta.' if backend == 'bert' else ['I made pasta.']!r}); "
+            "print(loaded - start, time.perf_counter() - start)")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1]}
+    load, first = (float(x) for x in result.stdout.split())
+    return {"load_s": load, "first_prediction_s": first}
+
+
+def percentiles(latencies):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {"p50_ms": p50, "p95_ms": p95, "p99_ms": p99, "mean_ms": float(np.mean(latencies)) * 1000}
+
+
+def run(predictor, backend, sentences, batch_size, threads, calls, warmup=3):
+    method = getattr(predictor, METHODS[backend])
+    batches = [[sentences[(i * batch_size + j) % len(sentences)] for j in range(batch_size)]
+               for i in range(calls + warmup)]
+    if backend == "bert":
+        batches = [batch[0] for batch in batches]
+    for batch in batches[:warmup]:
+        method(batch)
+
+    def timed(batch):
+        start = time.perf_counter()
+        method(batch)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = list(pool.map(timed, batches[warmup:]))
+    elapsed = time.perf_counter() - start
+    return {"backend": backend, "batch_size": batch_size, "threads": threads, "calls": calls,
+            "messages_per_sec": calls * batch_size / elapsed, **percentiles(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Predictor latency/throughput benchmark")
+    parser.add_argument("--backends", nargs="+", default=["simple", "svm"], choices=list(METHODS))
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--encoder", default="torch")
+    parser.add_argument("--head", default="sklearn")
+    parser.add_argument("--bundle", default=None)
+    parser.add_argument("--no-cold-start", action="store_true")
+    parser.add_argument("--out", default="bench_results.json")
+    args = parser.parse_args()
+
+    from modelPredict import Predictor
+    predictor_args = {"encoder": args.encoder, "head": args.head, "bundle": args.bundle}
+    sentences = load_sentences()
+    report = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                       "platform": platform.platform(), "args": vars(args)},
+              "cold_start": {}, "results": []}
+
+    for backend in args.backends:
+        if not args.no_cold_start:
+            report["cold_start"][backend] = cold_start(backend, predictor_args)
+            print(f"{backend} cold start: {report['cold_start'][backend]}")
+        predictor = Predictor(backends=(backend,), cache_size=0, **predictor_args)
+        for batch_size in ([1] if backend == "bert" else args.batch_sizes):
+            for threads in args.threads:
+                result = run(predictor, backend, sentences, batch_size, threads, args.calls)
+                report["results"].append(result)
+                print(f"{backend:6s} batch {batch_size:3d} threads {threads:2d}: "
+                      f"p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms  "
+                      f"p99 {result['p99_ms']:8.2f} ms  {result['messages_per_sec']:9.1f} msg/s")
+        predictor.close()
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
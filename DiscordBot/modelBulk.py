@@ -0,0 +1,116 @@
+# Streaming bulk classification for exported chat logs, used by `python modelPredict.py --input ...`.
+# Records are read lazily, classified in batches and appended to the output after every batch,
+# so memory use doesn't depend on the file size and an interrupted run can be resumed.
+
+import csv
+import json
+import math
+import os
+import sys
+import time
+
+# margin is in the units of the stage named in source, see modelPredict.SOURCES
+OUTPUT_FIELDS = ["offset", "id", "label", "margin", "probability", "source"]
+
+
+def read_records(path, text_field, id_field=None, start=0):
+    # Yields (offset, id, text) for every record from `start` on; offset is the record's index in the file
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        for offset, row in enumerate(rows):
+            if offset < start:
+                continue
+            text = row.get(text_field)
+            yield offset, row.get(id_field) if id_field else None, "" if text is None else str(text)
+
+
+def batched(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def resume_offset(path, chunk=64 * 1024):
+    # Offset to continue from, after dropping a last line that was only partly written
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return 0
+    with open(path, "rb+") as f:
+        # read backwards from the end until the tail holds the last complete line, not the whole file
+        size = start = f.seek(0, os.SEEK_END)
+        tail = b""
+        while start > 0 and tail.count(b"\n") < 2:
+            step = min(start, chunk)
+            start -= step
+            f.seek(start)
+            tail = f.read(step) + tail
+        end = start + tail.rfind(b"\n") + 1
+        if end != size:
+            f.truncate(end)
+        lines = tail[:end - start].splitlines()
+    if not lines or (path.endswith(".csv") and start == 0 and len(lines) == 1):
+        return 0
+    last = lines[-1].decode("utf-8")
+    if path.endswith(".jsonl"):
+        return json.loads(last)["offset"] + 1
+    return int(next(csv.reader([last]))[0]) + 1
+
+
+class ResultWriter:
+    def __init__(self, path, append):
+        exists = append and os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, "a" if append else "w", newline="", encoding="utf-8")
+        self.jsonl = path.endswith(".jsonl")
+        if not self.jsonl:
+            self.writer = csv.writer(self.file)
+            if not exists:
+                self.writer.writerow(OUTPUT_FIELDS)
+
+    def write(self, offset, record_id, label, margin, probability, source):
+        if self.jsonl:
+            self.file.write(json.dumps({"offset": offset, "id": record_id, "label": label,
+                                        "margin": margin, "probability": probability, "source": source}) + "\n")
+        else:
+            self.writer.writerow([offset, record_id, label, margin, "" if probability is None else probability, source])
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def classify_file(predictor, input_path, output_path, backend="svm", batch_size=256, text_field="sentence",
+                  id_field=None, start=0, resume=False, report_every=5.0):
+    if resume:
+        start = max(start, resume_offset(output_path))
+    writer = ResultWriter(output_path, append=resume)
+    processed = 0
+    began = last_report = time.perf_counter()
+    try:
+        for batch in batched(read_records(input_path, text_field, id_field, start), batch_size):
+            scores = predictor.score([text for _, _, text in batch], backend=backend)
+            for (offset, record_id, _), row in zip(batch, scores.rows()):
+                probability = None if math.isnan(row.probability) else round(row.probability, 5)
+                writer.write(offset, record_id, row.label, round(row.margin, 5), probability, row.source)
+            writer.flush()
+            processed += len(batch)
+
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                print(f"{processed} messages, offset {batch[-1][0]}, {processed / (now - began):.1f} msg/s",
+                      file=sys.stderr)
+                last_report = now
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - began
+    print(f"Classified {processed} messages from offset {start} in {elapsed:.1f}s "
+          f"({processed / elapsed if elapsed else 0:.1f} msg/s)", file=sys.stderr)
+    return processed
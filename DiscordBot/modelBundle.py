@@ -0,0 +1,201 @@
+# Versioned model bundle: a directory holding manifest.json plus one raw .npy file per array.
+# Arrays are loaded with mmap_mode="r", so loading is near instant and processes that load the same
+# bundle share its pages instead of each unpickling a private copy.
+# Build a bundle from the existing pickles (run from the DiscordBot directory):
+#   python modelBundle.py --out Models/bundle
+#   python modelBundle.py --svm Models/SVM_2/svm_model_bert.pkl --le Models/SVM_2/label_encoder.pkl --out Models/bundle_svm2
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+BUNDLE_VERSION = 1
+BUNDLE_DIR = "Models/bundle"
+MANIFEST = "manifest.json"
+
+
+class Bundle:
+    def __init__(self, path, manifest, arrays):
+        self.path = path
+        self.manifest = manifest
+        self.meta = manifest["meta"]
+        self.arrays = arrays
+
+    def group(self, prefix):
+        # Arrays stored as "<prefix>.<name>", returned keyed by name
+        start = len(prefix) + 1
+        return {name[start:]: array for name, array in self.arrays.items() if name.startswith(prefix + ".")}
+
+    def has(self, prefix):
+        return any(name.startswith(prefix + ".") for name in self.arrays)
+
+
+def save_bundle(path, arrays, meta=None):
+    os.makedirs(path, exist_ok=True)
+    entries = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        if array.dtype == object:
+            raise ValueError(f"Array {name} has dtype object and can't be memory-mapped")
+        filename = name + ".npy"
+        # write to a new file and rename it into place, so processes that still have the old
+        # file memory-mapped keep reading the old data instead of a truncated file
+        tmp_path = os.path.join(path, filename + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, array, allow_pickle=False)
+        os.replace(tmp_path, os.path.join(path, filename))
+        entries[name] = {"file": filename, "dtype": array.dtype.str, "shape": list(array.shape)}
+    manifest = {"version": BUNDLE_VERSION, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "arrays": entries, "meta": meta or {}}
+    # the manifest is written last, so a bundle without one is incomplete and watchers
+    # (see ModBot.watch_model_bundle) only see a change once every array is in place
+    tmp_path = os.path.join(path, MANIFEST + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(path, MANIFEST))
+
+
+def load_bundle(path=BUNDLE_DIR, mmap=True):
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest["version"] > BUNDLE_VERSION:
+        raise ValueError(f"Bundle {path} has version {manifest['version']}, this code reads up to {BUNDLE_VERSION}")
+    arrays = {}
+    for name, entry in manifest["arrays"].items():
+        array = np.load(os.path.join(path, entry["file"]), mmap_mode="r" if mmap else None, allow_pickle=False)
+        if list(array.shape) != entry["shape"]:
+            raise ValueError(f"Array {name} in {path} has shape {array.shape}, manifest says {entry['shape']}")
+        arrays[name] = array
+    return Bundle(path, manifest, arrays)
+
+
+class LinearProbabilityModel:
+    '''
+    predict_proba for a logistic regression stored in a bundle, so the cascade stage
+    doesn't need the pickled sklearn estimator.
+    '''
+    def __init__(self, coef, intercept, classes, multinomial=True):
+        self.coef = coef
+        self.intercept = intercept
+        self.classes_ = classes
+        self.multinomial = multinomial
+
+    def predict_proba(self, X):
+        scores = np.asarray(X @ self.coef.T) + self.intercept
+        if self.multinomial:
+            scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+        else:
+            scores = 1 / (1 + np.exp(-scores))
+        return scores / scores.sum(axis=1, keepdims=True)
+
+
+def tfidf_to_arrays(vectorizer):
+    terms = np.array(sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get))
+    params = {k: v for k, v in vectorizer.get_params().items()
+              if k not in ("dtype", "vocabulary") and (v is None or isinstance(v, (str, int, float, bool, tuple)))}
+    return {"terms": terms, "idf": vectorizer.idf_}, params
+
+
+def tfidf_from_bundle(bundle):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    arrays = bundle.group("tfidf")
+    params = dict(bundle.meta["tfidf"])
+    params["ngram_range"] = tuple(params["ngram_range"])
+    vectorizer = TfidfVectorizer(**params, vocabulary={str(term): i for i, term in enumerate(arrays["terms"])})
+    vectorizer.idf_ = np.asarray(arrays["idf"])
+    return vectorizer
+
+
+def cascade_from_bundle(bundle):
+    if not bundle.has("cascade"):
+        raise ValueError(f"Bundle {bundle.path} has no cascade model; train it with modelTrainCascade.py and rebuild the bundle")
+    arrays = bundle.group("cascade")
+    return LinearProbabilityModel(arrays["coef"], arrays["intercept"], arrays["classes"],
+                                  bundle.meta.get("cascade_multinomial", True))
+
+
+def convert(svm_path, le_path, tfidf_path, cascade_path, out, templates_path=None, train_path=None,
+            projection_path=None, head=None, extra_heads=None):
+    # head is an already compiled (e.g. compressed, see modelCompress.py) version of the SVM in svm_path;
+    # extra_heads maps head names to LinearHead .npz files from modelTrainHeads.py
+    import joblib
+    from modelHead import compile_svm, Projection, LinearHead
+
+    le = joblib.load(le_path)
+    if head is None:
+        head = compile_svm(joblib.load(svm_path), le)
+    arrays = {"head." + name: array for name, array in head.to_arrays().items()}
+    meta = {"labels": [str(label) for label in le.classes_],
+            "sources": {"svm": svm_path, "label_encoder": le_path}}
+
+    if projection_path:
+        # the SVM was trained on projected embeddings (modelTrainSVMBulk.py with PROJECTION set)
+        projection = Projection.load(projection_path)
+        if projection.components.shape[0] != head.input_dim:
+            raise ValueError(f"Projection {projection_path} outputs {projection.components.shape[0]} dimensions, "
+                             f"which doesn't match the SVM in {svm_path}")
+        arrays.update({"projection." + name: array for name, array in projection.to_arrays().items()})
+        meta["sources"]["projection"] = projection_path
+    for name, path in (extra_heads or {}).items():
+        arrays.update({f"heads.{name}.{key}": array for key, array in LinearHead.load(path).to_arrays().items()})
+        meta.setdefault("heads", []).append(name)
+        meta["sources"]["heads." + name] = path
+    if tfidf_path and os.path.exists(tfidf_path):
+        tfidf_arrays, meta["tfidf"] = tfidf_to_arrays(joblib.load(tfidf_path))
+        arrays.update({"tfidf." + name: array for name, array in tfidf_arrays.items()})
+        meta["sources"]["tfidf"] = tfidf_path
+    if cascade_path and os.path.exists(cascade_path):
+        cascade_model = joblib.load(cascade_path)
+        arrays.update({"cascade.coef": cascade_model.coef_, "cascade.intercept": cascade_model.intercept_,
+                       "cascade.classes": cascade_model.classes_})
+        meta["cascade_multinomial"] = getattr(cascade_model, "multi_class", "auto") != "ovr"
+        meta["sources"]["cascade"] = cascade_path
+    if templates_path and os.path.exists(templates_path):
+        # embedded with the same sentence encoder the SVM was trained on
+        from modelPredict import load_encoder, SENTENCE_MODEL
+        from modelTemplates import read_templates, build_index
+        index = build_index(load_encoder("torch"), *read_templates(templates_path))
+        arrays.update({"templates." + name: array for name, array in index.to_arrays().items()})
+        meta["templates_encoder"] = SENTENCE_MODEL
+        meta["sources"]["templates"] = templates_path
+    if train_path and os.path.exists(train_path):
+        # only the training half, so held-out sentences are still scored by the model when evaluating
+        from modelPredict import text_key, train_test_sentences
+        from modelExactMatch import build_table
+        sentences, _, labels, _ = train_test_sentences(train_path)
+        table, conflicting = build_table([text_key(t) for t in sentences], labels)
+        arrays.update({"exact." + name: array for name, array in table.to_arrays().items()})
+        meta["sources"]["exact_match"] = train_path
+        print(f"Exact-match table: {len(table)} sentences, {conflicting} left out for having conflicting labels")
+
+    save_bundle(out, arrays, meta)
+    size = sum(a.nbytes for a in arrays.values())
+    print(f"Wrote bundle {out} with {len(arrays)} arrays ({size / 1e6:.1f} MB)")
+
+
+def main():
+    from modelPredict import DATA_PATH
+    parser = argparse.ArgumentParser(description="Build a memory-mappable model bundle from the joblib pickles")
+    parser.add_argument("--svm", default="Models/SVM/svm_model_bert.pkl")
+    parser.add_argument("--le", default="Models/SVM/label_encoder.pkl")
+    parser.add_argument("--tfidf", default="Models/tfidf_vectorizer.pkl")
+    parser.add_argument("--cascade", default="Models/cascade_logistic.pkl")
+    parser.add_argument("--templates", default="FinalSubmissionExtraFiles/generate_dataset.py",
+                        help="generate_dataset.py to build the template index from")
+    parser.add_argument("--train-data", default=DATA_PATH,
+                        help="dataset CSV whose training split the exact-match table is built from")
+    parser.add_argument("--projection", default=None,
+                        help="projection .npz from modelTrainSVMBulk.py, when --svm was trained on projected embeddings")
+    parser.add_argument("--head", action="append", default=[], metavar="NAME=PATH",
+                        help="extra classifier head from modelTrainHeads.py, can be repeated")
+    parser.add_argument("--out", default=BUNDLE_DIR)
+    args = parser.parse_args()
+    extra_heads = dict(head.split("=", 1) for head in args.head)
+    convert(args.svm, args.le, args.tfidf, args.cascade, args.out, args.templates, args.train_data, args.projection,
+            extra_heads=extra_heads)
+
+
+if __name__ == "__main__":
+    main()
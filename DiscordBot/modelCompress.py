@@ -0,0 +1,134 @@
+# Shrinks the compiled SVC head by merging and pruning support vectors, reports size, latency and
+# accuracy against the original on the held-out split of modelTrainSVMBulk.py, and writes a model bundle.
+# Run from the DiscordBot directory:
+#   python modelCompress.py --out Models/bundle_compressed
+#   python modelCompress.py --merge-tolerance 0.01 --keep 0.8 --out Models/bundle_small
+#
+# Merging: the synthetic training data repeats the same few hundred sentences, so many support vectors
+# are identical. A kernel SVM's decision function is a sum over support vectors, so identical vectors
+# can be replaced by one vector carrying the summed coefficients without changing any prediction.
+# --merge-tolerance > 0 also merges vectors that only differ by less than the tolerance (per coordinate),
+# using their mean, which is an approximation.
+# Pruning: --keep < 1 drops the support vectors with the smallest coefficients, also an approximation.
+
+import argparse
+import time
+import numpy as np
+from modelHead import CompiledHead
+from modelPredict import DATA_PATH
+
+
+def merge_support_vectors(head, tolerance=0.0):
+    if tolerance > 0:
+        keys = np.round(np.asarray(head.support_vectors, dtype=np.float64) / tolerance)
+    else:
+        keys = np.asarray(head.support_vectors)
+    _, first, groups = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    groups = groups.reshape(-1)
+    weights = np.zeros((len(first), head.weights.shape[1]), dtype=np.float64)
+    np.add.at(weights, groups, head.weights)
+    if tolerance > 0:
+        vectors = np.zeros((len(first), head.support_vectors.shape[1]), dtype=np.float64)
+        np.add.at(vectors, groups, head.support_vectors)
+        vectors /= np.bincount(groups)[:, None]
+    else:
+        vectors = head.support_vectors[first]
+    return _with_support_vectors(head, vectors, weights)
+
+
+def prune_support_vectors(head, keep):
+    # keeps the fraction `keep` of support vectors with the largest coefficient in any class pair
+    importance = np.max(np.abs(head.weights), axis=1)
+    count = max(1, int(round(keep * len(importance))))
+    kept = np.sort(np.argsort(-importance)[:count])
+    return _with_support_vectors(head, head.support_vectors[kept], head.weights[kept])
+
+
+def _with_support_vectors(head, vectors, weights):
+    dtype = head.weights.dtype
+    return CompiledHead(head.kernel, np.asarray(weights, dtype=dtype), head.intercepts, head.pairs, head.labels,
+                        np.asarray(vectors, dtype=dtype), head.gamma, head.coef0, head.degree, head.prob_a, head.prob_b)
+
+
+def held_out_split(le):
+    # same split as modelTrainSVMBulk.py
+    from modelPredict import train_test_sentences
+    _, X_test, _, y_test = train_test_sentences(DATA_PATH)
+    return X_test, le.transform(y_test)
+
+
+def size_mb(head):
+    return sum(a.nbytes for a in head.to_arrays().values()) / 1e6
+
+
+def latency_ms(head, X, calls=200, batch_size=1):
+    start = time.perf_counter()
+    for i in range(calls):
+        j = (i * batch_size) % len(X)
+        head.score(X[j:j + batch_size])
+    return (time.perf_counter() - start) / calls * 1000
+
+
+def report(name, head, X, y, reference):
+    from sklearn.metrics import accuracy_score, f1_score
+    predicted = head.predict_index(X)
+    return {"name": name, "support_vectors": len(head.support_vectors), "size_mb": size_mb(head),
+            "ms_per_message": latency_ms(head, X), "ms_per_batch_64": latency_ms(head, X, 50, 64),
+            "accuracy": accuracy_score(y, predicted), "macro_f1": f1_score(y, predicted, average='macro'),
+            "agreement": float(np.mean(predicted == reference))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge/prune the SVC's support vectors and build a bundle from the result")
+    parser.add_argument("--svm", default="Models/SVM/svm_model_bert.pkl")
+    parser.add_argument("--le", default="Models/SVM/label_encoder.pkl")
+    parser.add_argument("--projection", default=None, help="projection .npz the SVM was trained with, if any")
+    parser.add_argument("--merge-tolerance", type=float, default=0.0,
+                        help="0 merges identical support vectors only, which doesn't change predictions")
+    parser.add_argument("--keep", type=float, default=1.0, help="fraction of support vectors to keep after merging")
+    parser.add_argument("--tfidf", default="Models/tfidf_vectorizer.pkl")
+    parser.add_argument("--cascade", default="Models/cascade_logistic.pkl")
+    parser.add_argument("--templates", default="FinalSubmissionExtraFiles/generate_dataset.py")
+    parser.add_argument("--train-data", default=DATA_PATH)
+    parser.add_argument("--out", default=None, help="bundle directory to write; only the report is printed without it")
+    args = parser.parse_args()
+
+    import joblib
+    from modelHead import compile_svm, Projection
+    from modelPredict import load_encoder, encode_by_length
+
+    le = joblib.load(args.le)
+    original = compile_svm(joblib.load(args.svm), le)
+    if original.support_vectors is None:
+        raise SystemExit("The SVM has a linear kernel and is already one weight vector per class pair, nothing to compress")
+
+    compressed = merge_support_vectors(original, args.merge_tolerance)
+    if args.keep < 1:
+        compressed = prune_support_vectors(compressed, args.keep)
+
+    sentences, y_test = held_out_split(le)
+    X_test = encode_by_length(load_encoder("torch"), sentences)
+    if args.projection:
+        X_test = Projection.load(args.projection).transform(X_test)
+    reference = original.predict_index(X_test)
+
+    rows = [report("original", original, X_test, y_test, reference),
+            report("compressed", compressed, X_test, y_test, reference)]
+    print(f"{'':10s}  {'SVs':>6s}  {'MB':>6s}  {'ms/msg':>7s}  {'ms/64':>7s}  {'accuracy':>8s}  {'macro F1':>8s}  {'agreement':>9s}")
+    for row in rows:
+        print(f"{row['name']:10s}  {row['support_vectors']:6d}  {row['size_mb']:6.2f}  {row['ms_per_message']:7.3f}  "
+              f"{row['ms_per_batch_64']:7.3f}  {row['accuracy']:8.4f}  {row['macro_f1']:8.4f}  {row['agreement']:9.4f}")
+    before, after = rows
+    print(f"delta       {after['support_vectors'] - before['support_vectors']:+6d}  "
+          f"{after['size_mb'] - before['size_mb']:+6.2f}  {after['ms_per_message'] - before['ms_per_message']:+7.3f}  "
+          f"{after['ms_per_batch_64'] - before['ms_per_batch_64']:+7.3f}  {after['accuracy'] - before['accuracy']:+8.4f}  "
+          f"{after['macro_f1'] - before['macro_f1']:+8.4f}")
+
+    if args.out:
+        from modelBundle import convert
+        convert(args.svm, args.le, args.tfidf, args.cascade, args.out, args.templates, args.train_data,
+                args.projection, head=compressed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# Exact-match table of the training sentences, used by Predictor(exact_match=True) to label messages that
+# repeat a sentence from the training split of FinalData.csv (modelPredict.train_test_sentences, after
+# modelPredict.normalize_text) without encoding them.
+# The table is two arrays sorted by key, 64-bit text hashes and 1-byte label codes (9 bytes per sentence),
+# built when a model bundle is created (modelBundle.py --train-data ...) and loaded from it memory-mapped.
+
+import numpy as np
+
+
+def hash_keys(keys):
+    # modelPredict.text_key digests -> uint64 table keys
+    return np.array([int.from_bytes(key[:8], "little") for key in keys], dtype=np.uint64)
+
+
+class ExactMatchTable:
+    def __init__(self, hashes, codes, labels):
+        self.hashes = hashes    # (n,) sorted uint64 text hashes
+        self.codes = codes      # (n,) uint8 index into labels
+        self.labels = labels    # (n_classes,) label strings
+
+    def lookup(self, hashes):
+        # Label code per hash, -1 where the text isn't in the table
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if not len(self.hashes):
+            return np.full(len(hashes), -1, dtype=np.int16)
+        positions = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        found = self.hashes[positions] == hashes
+        return np.where(found, self.codes[positions].astype(np.int16), -1)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def to_arrays(self):
+        return {"hashes": self.hashes, "codes": self.codes, "labels": self.labels}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["hashes"], arrays["codes"], arrays["labels"])
+
+
+def build_table(keys, labels):
+    # keys are text_key digests of the training sentences; a sentence seen with more than one
+    # label is left out, since repeating it says nothing about which label is right
+    hashes = hash_keys(keys)
+    names, codes = np.unique(np.asarray(labels).astype(str), return_inverse=True)
+    order = np.lexsort((codes, hashes))
+    hashes, codes = hashes[order], codes[order]
+    first = np.concatenate([[True], hashes[1:] != hashes[:-1]])
+    groups = np.cumsum(first) - 1
+    conflicting = np.zeros(first.sum(), dtype=bool)
+    np.logical_or.at(conflicting, groups, codes != codes[np.flatnonzero(first)][groups])
+    keep = first & ~conflicting[groups]
+    return ExactMatchTable(hashes[keep], codes[keep].astype(np.uint8), names), int(conflicting.sum())
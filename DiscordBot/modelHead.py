@@ -0,0 +1,287 @@
+# Compiles the trained SVC + LabelEncoder into plain numpy arrays so prediction doesn't go through
+# sklearn's validation on every call. Run from the DiscordBot directory to (re)build the head:
+#   python modelHead.py
+# which reads Models/SVM/svm_model_bert.pkl and Models/SVM/label_encoder.pkl and writes Models/SVM/svm_head.npz.
+
+import numpy as np
+
+HEAD_PATH = "Models/SVM/svm_head.npz"
+KERNELS = ("linear", "rbf", "poly", "sigmoid")
+
+
+class CompiledHead:
+    '''
+    One-vs-one SVC decision function in numpy. For a linear kernel each class pair is reduced to
+    one weight vector; otherwise the support vectors are kept in one matrix with a per-pair
+    coefficient matrix, so every pair is scored by a single kernel evaluation + matmul.
+    '''
+    def __init__(self, kernel, weights, intercepts, pairs, labels, support_vectors=None,
+                 gamma=0.0, coef0=0.0, degree=3, prob_a=None, prob_b=None):
+        self.kernel = kernel
+        self.weights = weights          # (d, n_pairs) for linear, (n_sv, n_pairs) otherwise
+        self.intercepts = intercepts    # (n_pairs,)
+        self.pairs = pairs              # (n_pairs, 2) class indices voted for when dec > 0 / <= 0
+        self.labels = labels            # class index -> label string
+        self.support_vectors = support_vectors
+        self.gamma = gamma
+        self.coef0 = coef0
+        self.degree = degree
+        self.prob_a = prob_a            # per-pair Platt scaling, only for SVCs trained with probability=True
+        self.prob_b = prob_b
+        if support_vectors is not None:
+            self.sv_norms = np.einsum('ij,ij->i', support_vectors, support_vectors)
+
+    @property
+    def input_dim(self):
+        return self.weights.shape[0] if self.support_vectors is None else self.support_vectors.shape[1]
+
+    def kernel_matrix(self, X):
+        if self.kernel == "linear":
+            return X
+        dot = X @ self.support_vectors.T
+        if self.kernel == "rbf":
+            x_norms = np.einsum('ij,ij->i', X, X)[:, None]
+            return np.exp(-self.gamma * np.maximum(x_norms + self.sv_norms[None, :] - 2 * dot, 0))
+        if self.kernel == "poly":
+            return (self.gamma * dot + self.coef0) ** self.degree
+        if self.kernel == "sigmoid":
+            return np.tanh(self.gamma * dot + self.coef0)
+        raise ValueError(f"Unknown kernel {self.kernel!r}")
+
+    def decision_function(self, X):
+        # Raw libsvm pairwise decision values, shape (n, n_pairs)
+        X = np.asarray(X, dtype=self.weights.dtype)
+        return self.kernel_matrix(X) @ self.weights + self.intercepts
+
+    def _votes(self, dec):
+        winners = np.where(dec > 0, self.pairs[:, 0], self.pairs[:, 1])
+        votes = np.zeros((len(dec), len(self.labels)), dtype=np.int32)
+        for c in range(len(self.labels)):
+            votes[:, c] = np.count_nonzero(winners == c, axis=1)
+        return votes
+
+    def predict_index(self, X):
+        # argmax takes the lowest class index on ties, same as libsvm
+        return np.argmax(self._votes(self.decision_function(X)), axis=1)
+
+    def _ovr_scores(self, dec, votes):
+        # Matches SVC.decision_function with decision_function_shape="ovr": votes plus the summed
+        # pairwise confidences squashed into (-1/3, 1/3)
+        confidences = np.zeros(votes.shape, dtype=dec.dtype)
+        for p, (i, j) in enumerate(self.pairs):
+            confidences[:, i] += dec[:, p]
+            confidences[:, j] -= dec[:, p]
+        return votes + confidences / (3 * (np.abs(confidences) + 1))
+
+    def _probabilities(self, dec):
+        # libsvm's svm_predict_probability: Platt-scaled pairwise probabilities combined by pairwise coupling
+        n, k = len(dec), len(self.labels)
+        f = dec * self.prob_a + self.prob_b
+        pairwise = np.where(f >= 0, np.exp(-np.abs(f)) / (1 + np.exp(-np.abs(f))), 1 / (1 + np.exp(-np.abs(f))))
+        pairwise = np.clip(pairwise, 1e-7, 1 - 1e-7)
+        r = np.zeros((n, k, k))
+        for p, (i, j) in enumerate(self.pairs):
+            r[:, i, j] = pairwise[:, p]
+            r[:, j, i] = 1 - pairwise[:, p]
+
+        Q = -r.transpose(0, 2, 1) * r
+        diagonal = np.einsum('njt,njt->nt', r, r) - np.einsum('ntt,ntt->nt', r, r)
+        Q[:, np.arange(k), np.arange(k)] = diagonal
+        probabilities = np.full((n, k), 1.0 / k)
+        active = np.arange(n)
+        for _ in range(max(100, k)):
+            Qa, p = Q[active], probabilities[active]
+            Qp = np.einsum('ntj,nj->nt', Qa, p)
+            pQp = np.einsum('nt,nt->n', p, Qp)
+            # like libsvm, stop iterating a message as soon as it has converged
+            converged = np.max(np.abs(Qp - pQp[:, None]), axis=1) < 0.005 / k
+            active, Qa, p, Qp, pQp = active[~converged], Qa[~converged], p[~converged], Qp[~converged], pQp[~converged]
+            if not len(active):
+                break
+            for t in range(k):
+                diff = (-Qp[:, t] + pQp) / Qa[:, t, t]
+                p[:, t] += diff
+                pQp = (pQp + diff * (diff * Qa[:, t, t] + 2 * Qp[:, t])) / (1 + diff) ** 2
+                Qp = (Qp + diff[:, None] * Qa[:, t, :]) / (1 + diff[:, None])
+                p /= (1 + diff[:, None])
+            probabilities[active] = p
+        return probabilities
+
+    def score(self, X):
+        # Class indices, one-vs-rest scores and (if calibrated) class probabilities from one kernel evaluation
+        dec = self.decision_function(X)
+        votes = self._votes(dec)
+        probabilities = self._probabilities(dec.astype(np.float64)) if self.prob_a is not None else None
+        return np.argmax(votes, axis=1), self._ovr_scores(dec, votes), probabilities
+
+    def predict(self, X):
+        return self.labels[self.predict_index(X)]
+
+    def to_arrays(self):
+        arrays = dict(kernel=np.array(self.kernel), weights=self.weights, intercepts=self.intercepts,
+                      pairs=self.pairs, labels=self.labels,
+                      params=np.array([self.gamma, self.coef0, self.degree], dtype=np.float64))
+        if self.support_vectors is not None:
+            arrays["support_vectors"] = self.support_vectors
+        if self.prob_a is not None:
+            arrays["prob_a"] = self.prob_a
+            arrays["prob_b"] = self.prob_b
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        # arrays can be an npz file or memory-mapped arrays from a model bundle
+        gamma, coef0, degree = arrays["params"]
+        # memory-mapped 0-d arrays come back as 1 element arrays
+        kernel = str(np.asarray(arrays["kernel"]).reshape(-1)[0])
+        return cls(kernel, arrays["weights"], arrays["intercepts"], arrays["pairs"],
+                   arrays["labels"], arrays["support_vectors"] if "support_vectors" in arrays else None,
+                   float(gamma), float(coef0), int(degree),
+                   arrays["prob_a"] if "prob_a" in arrays else None, arrays["prob_b"] if "prob_b" in arrays else None)
+
+    def save(self, path=HEAD_PATH):
+        np.savez(path, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path=HEAD_PATH):
+        with np.load(path, allow_pickle=False) as data:
+            return cls.from_arrays(data)
+
+
+class Projection:
+    '''
+    Linear map applied to embeddings before the head, (x - mean) @ components.T. Stores a fitted
+    sklearn PCA or random projection (see modelTrainSVMBulk.py) as plain arrays.
+    '''
+    def __init__(self, mean, components):
+        self.mean = mean                # (d,)
+        self.components = components    # (k, d)
+
+    @classmethod
+    def from_sklearn(cls, model, dtype=np.float32):
+        components = model.components_.toarray() if hasattr(model.components_, "toarray") else model.components_
+        mean = getattr(model, "mean_", None)
+        if mean is None:
+            mean = np.zeros(components.shape[1])
+        return cls(np.asarray(mean, dtype=dtype), np.asarray(components, dtype=dtype))
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=self.components.dtype) - self.mean) @ self.components.T
+
+    def to_arrays(self):
+        return {"mean": self.mean, "components": self.components}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["mean"], arrays["components"])
+
+    def save(self, path):
+        np.savez(path, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls.from_arrays(data)
+
+
+class LinearHead:
+    '''
+    Linear classifier over the sentence embedding (a fitted LogisticRegression as plain arrays), used for
+    the extra heads Predictor.classify runs next to the SVM, e.g. the report categories from report.py.
+    '''
+    def __init__(self, coef, intercept, labels):
+        self.coef = coef            # (k, d), or (1, d) for a two-class logistic regression
+        self.intercept = intercept  # (k,) or (1,)
+        self.labels = labels        # (n_classes,) label strings
+
+    @classmethod
+    def from_sklearn(cls, model, dtype=np.float32):
+        return cls(np.asarray(model.coef_, dtype=dtype), np.asarray(model.intercept_, dtype=dtype),
+                   np.asarray(model.classes_).astype(str))
+
+    def probabilities(self, X):
+        scores = np.asarray(X, dtype=self.coef.dtype) @ self.coef.T + self.intercept
+        if scores.shape[1] == 1:
+            positive = 1 / (1 + np.exp(-scores[:, 0]))
+            return np.stack([1 - positive, positive], axis=1)
+        scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return scores / scores.sum(axis=1, keepdims=True)
+
+    def to_arrays(self):
+        return {"coef": self.coef, "intercept": self.intercept, "labels": self.labels}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["coef"], arrays["intercept"], arrays["labels"])
+
+    def save(self, path):
+        np.savez(path, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls.from_arrays(data)
+
+
+def compile_svm(svm_model, le, dtype=np.float32):
+    # Accepts a fitted SVC (or a search object wrapping one) and the LabelEncoder used to train it
+    svm_model = getattr(svm_model, "best_estimator_", svm_model)
+    if svm_model.kernel not in KERNELS:
+        raise ValueError(f"Can't compile SVC with kernel {svm_model.kernel!r}")
+
+    # libsvm's own coefficients / intercepts; sklearn flips the sign of the public ones for binary problems
+    dual_coef = np.asarray(svm_model._dual_coef_.toarray() if hasattr(svm_model._dual_coef_, "toarray")
+                           else svm_model._dual_coef_, dtype=np.float64)
+    intercepts = np.asarray(svm_model._intercept_, dtype=np.float64)
+    support_vectors = np.asarray(svm_model.support_vectors_, dtype=np.float64)
+    n_support = np.asarray(svm_model._n_support if hasattr(svm_model, "_n_support") else svm_model.n_support_)
+    starts = np.concatenate([[0], np.cumsum(n_support)])
+    n_classes = len(n_support)
+
+    pairs = []
+    coef = np.zeros((len(support_vectors), n_classes * (n_classes - 1) // 2))
+    p = 0
+    for i in range(n_classes):
+        for j in range(i + 1, n_classes):
+            coef[starts[i]:starts[i + 1], p] = dual_coef[j - 1, starts[i]:starts[i + 1]]
+            coef[starts[j]:starts[j + 1], p] = dual_coef[i, starts[j]:starts[j + 1]]
+            pairs.append((i, j))
+            p += 1
+    pairs = np.array(pairs, dtype=np.int32)
+
+    labels = np.asarray(le.inverse_transform(svm_model.classes_)).astype(str)
+    prob_a = prob_b = None
+    if hasattr(svm_model, "predict_proba"):  # only fitted with probability=True
+        prob_a = np.asarray(svm_model.probA_, dtype=np.float64)
+        prob_b = np.asarray(svm_model.probB_, dtype=np.float64)
+    if svm_model.kernel == "linear":
+        return CompiledHead("linear", (support_vectors.T @ coef).astype(dtype), intercepts.astype(dtype),
+                            pairs, labels, prob_a=prob_a, prob_b=prob_b)
+
+    # keep only support vectors that contribute to at least one pair
+    used = np.any(coef != 0, axis=1)
+    return CompiledHead(svm_model.kernel, coef[used].astype(dtype), intercepts.astype(dtype), pairs, labels,
+                        support_vectors[used].astype(dtype), float(svm_model._gamma),
+                        float(svm_model.coef0), int(svm_model.degree), prob_a, prob_b)
+
+
+def main():
+    import joblib
+    svm_model = joblib.load("Models/SVM/svm_model_bert.pkl")
+    le = joblib.load("Models/SVM/label_encoder.pkl")
+    head = compile_svm(svm_model, le)
+
+    # sanity check against sklearn on the support vectors and some random embeddings
+    svm_model = getattr(svm_model, "best_estimator_", svm_model)
+    rng = np.random.default_rng(0)
+    X = np.concatenate([svm_model.support_vectors_[:2000],
+                        rng.standard_normal((1000, svm_model.support_vectors_.shape[1])) * 0.05])
+    expected = le.inverse_transform(svm_model.predict(X))
+    agreement = np.mean(head.predict(X) == expected)
+    head.save(HEAD_PATH)
+    print(f"Compiled {svm_model.kernel} SVC with {len(svm_model.support_vectors_)} support vectors to {HEAD_PATH}")
+    print(f"Agreement with sklearn: {agreement:.4%}")
+
+
+if __name__ == "__main__":
+    main()
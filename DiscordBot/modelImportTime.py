@@ -0,0 +1,53 @@
+# Summarizes `python -X importtime` for each Predictor backend so we can see what each one pulls in.
+# Run from the DiscordBot directory:
+#   python modelImportTime.py                 # all backends
+#   python modelImportTime.py simple --top 15
+
+import argparse
+import subprocess
+import sys
+import time
+
+BACKENDS = ("none", "simple", "svm", "bert")
+
+
+def run(backend):
+    # "none" only imports modelPredict; the others also construct a Predictor that loads that backend
+    code = "import modelPredict"
+    if backend != "none":
+        code += f"; modelPredict.Predictor(backends=({backend!r},))"
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    wall = time.perf_counter() - start
+
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented further; a top-level cumulative time includes everything it imports
+        if not name[1:].startswith(" "):
+            name = name.strip().split(".")[0]
+            packages[name] = packages.get(name, 0) + int(cumulative)
+    return wall, packages, result.returncode, result.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time report per Predictor backend")
+    parser.add_argument("backends", nargs="*", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    for backend in args.backends:
+        wall, packages, returncode, stderr = run(backend)
+        total = sum(packages.values())
+        print(f"== {backend}: {wall:.2f}s wall (imports {total / 1e6:.2f}s)")
+        if returncode != 0:
+            print(stderr.strip().splitlines()[-1])
+            continue
+        for name, us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+            print(f"  {us / 1000:9.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
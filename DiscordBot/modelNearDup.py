@@ -0,0 +1,150 @@
+# Near-duplicate lookup for recently classified messages, used by Predictor(near_dup=True).
+# Each message gets a MinHash signature over the character shingles of its normalized text, and
+# messages whose estimated Jaccard similarity is at least `threshold` reuse the earlier result.
+# Signatures are split into LSH bands and indexed per band, so a lookup only compares against
+# messages that share at least one band exactly instead of scanning the whole window.
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+PRIME = np.uint64((1 << 31) - 1)
+PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+# Shingles barely change when one of these is added or removed, but the meaning flips
+# ("i want to die" / "i don't want to die"), so messages that differ in them never match
+NEGATIONS = frozenset(["no", "not", "never", "nothing", "nobody", "dont", "cant", "wont", "isnt", "arent",
+                       "didnt", "doesnt", "wasnt", "werent", "shouldnt", "wouldnt", "couldnt", "aint"])
+
+
+def shingle_hashes(text, size=4):
+    if len(text) <= size:
+        parts = [text]
+    else:
+        parts = {text[i:i + size] for i in range(len(text) - size + 1)}
+    return np.array([int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest(), 'little')
+                     for s in parts], dtype=np.uint64)
+
+
+def negations(text):
+    return NEGATIONS.intersection(text.split())
+
+
+class NearDuplicateIndex:
+    '''
+    Recent-window store of (MinHash signature, result) for classified messages. Holds at most max_size
+    messages, oldest dropped first, and entries expire after ttl seconds.
+    Messages shorter than min_chars are never matched: a few changed characters is a different message.
+    '''
+    def __init__(self, threshold=0.8, max_size=4096, ttl=600, min_chars=24, num_perm=64, bands=16,
+                 shingle_size=4, seed=0):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.min_chars = min_chars
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        # h(x) = (a * x + b) mod p; a, x < 2^31 so the product fits in 64 bits
+        self.a = rng.integers(1, int(PRIME), num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, int(PRIME), num_perm, dtype=np.uint64)
+        self.entries = OrderedDict()    # id -> (signature, text, value, time stored)
+        self.buckets = [{} for _ in range(bands)]   # band bytes -> set of ids
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    def prepare(self, normalized):
+        # normalized is modelPredict.normalize_text output; punctuation doesn't make a message different
+        return PUNCTUATION_RE.sub('', normalized)
+
+    def signature(self, text):
+        if len(text) < self.min_chars:
+            return None
+        hashes = shingle_hashes(text, self.shingle_size) % PRIME
+        return ((hashes[:, None] * self.a + self.b) % PRIME).min(axis=0).astype(np.uint32)
+
+    def _bands(self, signature):
+        return [signature[b * self.rows:(b + 1) * self.rows].tobytes() for b in range(self.bands)]
+
+    def _remove(self, entry_id):
+        signature = self.entries.pop(entry_id)[0]
+        for bucket, band in zip(self.buckets, self._bands(signature)):
+            ids = bucket[band]
+            ids.discard(entry_id)
+            if not ids:
+                del bucket[band]
+
+    def _expire(self):
+        while self.entries and self.ttl is not None:
+            oldest_id = next(iter(self.entries))
+            if time.monotonic() - self.entries[oldest_id][3] <= self.ttl:
+                break
+            self._remove(oldest_id)
+
+    def get(self, normalized):
+        # (value, estimated similarity, matched text) of the most similar recent message, or None
+        text = self.prepare(normalized)
+        signature = self.signature(text)
+        with self.lock:
+            if signature is None:
+                self.skipped += 1
+                return None
+            self._expire()
+            candidates = set()
+            for bucket, band in zip(self.buckets, self._bands(signature)):
+                candidates.update(bucket.get(band, ()))
+            best = None
+            if candidates:
+                candidates = list(candidates)
+                similarities = np.mean(np.stack([self.entries[c][0] for c in candidates]) == signature, axis=1)
+                for k in np.argsort(-similarities):
+                    if similarities[k] < self.threshold:
+                        break
+                    _, other_text, value, _ = self.entries[candidates[k]]
+                    if negations(text) == negations(other_text):
+                        best = (value, float(similarities[k]), other_text)
+                        break
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return best
+
+    def put(self, normalized, value):
+        text = self.prepare(normalized)
+        signature = self.signature(text)
+        if signature is None:
+            return
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = (signature, text, value, time.monotonic())
+            for bucket, band in zip(self.buckets, self._bands(signature)):
+                bucket.setdefault(band, set()).add(entry_id)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.buckets = [{} for _ in range(self.bands)]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "too_short": self.skipped,
+        }
@@ -0,0 +1,100 @@
+# Exports the MiniLM sentence encoder to ONNX (optionally int8 quantized) and checks how far
+# the exported encoders drift from the PyTorch SentenceTransformer on FinalData.csv.
+# Run from the DiscordBot directory:
+#   python modelOnnx.py export
+#   python modelOnnx.py check --limit 2000
+
+import argparse
+import os
+import time
+import numpy as np
+import joblib
+from modelPredict import DATA_PATH, ONNX_DIR, SENTENCE_MODEL, load_encoder, train_test_sentences
+
+
+def export(output_dir=ONNX_DIR, quantize=True, opset=14):
+    import torch
+    from transformers import AutoTokenizer, AutoModel
+
+    os.makedirs(output_dir, exist_ok=True)
+    name = "sentence-transformers/" + SENTENCE_MODEL
+    tokenizer = AutoTokenizer.from_pretrained(name)
+    model = AutoModel.from_pretrained(name).eval()
+
+    dummy = tokenizer(["This is an example sentence."], return_tensors="pt")
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    dynamic_axes = {n: {0: "batch", 1: "sequence"} for n in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    model_path = os.path.join(output_dir, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(dummy[n] for n in input_names), model_path,
+                          input_names=input_names, output_names=["last_hidden_state"],
+                          dynamic_axes=dynamic_axes, opset_version=opset)
+    tokenizer.save_pretrained(output_dir)
+    print(f"Exported {model_path}")
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantized_path = os.path.join(output_dir, "model_int8.onnx")
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+        print(f"Exported {quantized_path}")
+
+
+def load_test_split(limit=None):
+    # Same held-out split as modelTrainSVMBulk.py
+    _, X_test, _, y_test = train_test_sentences(DATA_PATH)
+    y_test = y_test.tolist()
+    if limit:
+        X_test, y_test = X_test[:limit], y_test[:limit]
+    return X_test, y_test
+
+
+def timed_encode(encoder, sentences, batch_size):
+    start = time.perf_counter()
+    embeddings = encoder.encode(sentences, batch_size=batch_size, convert_to_numpy=True)
+    return embeddings, time.perf_counter() - start
+
+
+def check(backends=("onnx", "onnx-int8"), limit=None, batch_size=32):
+    svm_model = joblib.load("Models/SVM/svm_model_bert.pkl")
+    le = joblib.load("Models/SVM/label_encoder.pkl")
+    sentences, labels = load_test_split(limit)
+    y_true = le.transform(labels)
+
+    reference, reference_time = timed_encode(load_encoder("torch"), sentences, batch_size)
+    reference_pred = svm_model.predict(reference)
+    reference_acc = float(np.mean(reference_pred == y_true))
+    print(f"torch: accuracy {reference_acc:.4f}, {1000 * reference_time / len(sentences):.3f} ms/message")
+
+    for backend in backends:
+        embeddings, elapsed = timed_encode(load_encoder(backend), sentences, batch_size)
+        cosine = np.sum(embeddings * reference, axis=1) / (
+            np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference, axis=1))
+        pred = svm_model.predict(embeddings)
+        acc = float(np.mean(pred == y_true))
+        print(f"{backend}: accuracy {acc:.4f} ({acc - reference_acc:+.4f} vs torch), "
+              f"label agreement {np.mean(pred == reference_pred):.4f}, "
+              f"cosine mean {cosine.mean():.5f} min {cosine.min():.5f}, "
+              f"{1000 * elapsed / len(sentences):.3f} ms/message ({reference_time / elapsed:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and validate ONNX MiniLM encoders")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export_parser = sub.add_parser("export")
+    export_parser.add_argument("--output-dir", default=ONNX_DIR)
+    export_parser.add_argument("--no-quantize", action="store_true")
+    check_parser = sub.add_parser("check")
+    check_parser.add_argument("--backends", nargs="+", default=["onnx", "onnx-int8"])
+    check_parser.add_argument("--limit", type=int, default=None)
+    check_parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.output_dir, quantize=not args.no_quantize)
+    else:
+        check(args.backends, args.limit, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
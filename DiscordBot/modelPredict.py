@@ -1,52 +1,787 @@
 import os
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
-from transformers import DistilBertTokenizer, DistilBertForSequenceClassification
-from sentence_transformers import SentenceTransformer
-import torch
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from typing import NamedTuple
+import argparse
+import asyncio
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import re
+import threading
+import time
+import numpy as np
 import joblib
+from modelHead import CompiledHead, Projection, LinearHead, HEAD_PATH
+from modelBundle import load_bundle, tfidf_from_bundle, cascade_from_bundle
+from modelNearDup import NearDuplicateIndex
+from modelTemplates import TemplateIndex
+from modelExactMatch import ExactMatchTable, hash_keys
+
+MENTION_RE = re.compile(r'<(?:@[!&]?|#)\d+>|@(?:everyone|here)')
+URL_RE = re.compile(r'https?://\S+|www\.\S+')
+WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_text(text):
+    # Lowercase and strip mentions, URLs and extra whitespace so copy-pasted spam maps to the same key
+    text = MENTION_RE.sub(' ', text.lower())
+    text = URL_RE.sub(' ', text)
+    return WHITESPACE_RE.sub(' ', text).strip()
+
+def text_key(text):
+    return hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size=16).digest()
+
+logger = logging.getLogger('discord')
+
+# Sentences used to warm up a freshly loaded model before it serves messages
+WARMUP_SENTENCES = ["I feel like giving up today.", "I'm doing better now.", "I don't want to keep on going",
+                    "I felt resilient after the breakup often but I’m staying strong.", "I loved the end of that movie"]
+
+ONNX_DIR = "Models/ONNX"
+CASCADE_MODEL_PATH = "Models/cascade_logistic.pkl"
+SENTENCE_MODEL = 'all-MiniLM-L6-v2'
+DATA_PATH = "FinalSubmissionExtraFiles/FinalData.csv"
+
+
+def train_test_sentences(path=DATA_PATH):
+    # The train / held-out split modelTrainSVMBulk.py trains on, for every script that evaluates against it:
+    # (train sentences, test sentences, train labels, test labels). Rows with a missing sentence are dropped
+    # after splitting, so they can't shift other rows between the two halves
+    import pandas as pd
+    from sklearn.model_selection import train_test_split
+    df = pd.read_csv(path, usecols=['sentence', 'label'])
+    train, test = train_test_split(df, test_size=0.12, stratify=df['label'], random_state=42)
+    train, test = train.dropna(), test.dropna()
+    return (train['sentence'].astype(str).tolist(), test['sentence'].astype(str).tolist(),
+            train['label'].to_numpy(), test['label'].to_numpy())
+
+class OnnxEncoder:
+    '''
+    Runs the MiniLM transformer exported by modelOnnx.py with ONNX Runtime and applies the same
+    mean pooling + L2 normalization as SentenceTransformer, so embeddings stay compatible with
+    svm_model_bert.pkl. Has the same encode() signature as SentenceTransformer.
+    '''
+    def __init__(self, model_path, tokenizer_dir=ONNX_DIR, max_length=256, threads=None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir)
+        self.max_length = max_length
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, **kwargs):
+        # Like SentenceTransformer.encode, batches sentences of similar length so short ones aren't padded to
+        # the longest in the batch; the tokenizer runs once and each batch is padded from its output
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        if not len(sentences):
+            return np.zeros((0, 384), dtype=np.float32)
+        encoded = self.tokenizer(list(sentences), truncation=True, max_length=self.max_length)
+        order = np.argsort([len(ids) for ids in encoded["input_ids"]], kind="stable")
+        embeddings = np.empty((len(sentences), 384), dtype=np.float32)
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            inputs = self.tokenizer.pad({key: [values[i] for i in idx] for key, values in encoded.items()},
+                                        return_tensors="np")
+            feeds = {name: inputs[name].astype(np.int64) for name in self.input_names if name in inputs}
+            token_embeddings = self.session.run(None, feeds)[0]
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            embeddings[idx] = pooled
+        return embeddings
+
+def load_encoder(backend="torch"):
+    # backend is "torch" (SentenceTransformer), "onnx" or "onnx-int8" (dynamically quantized export)
+    if backend == "torch":
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(SENTENCE_MODEL)
+    if backend == "onnx":
+        return OnnxEncoder(os.path.join(ONNX_DIR, "model.onnx"))
+    if backend == "onnx-int8":
+        return OnnxEncoder(os.path.join(ONNX_DIR, "model_int8.onnx"))
+    raise ValueError(f"Unknown encoder backend: {backend}")
+
+def token_lengths(encoder, texts):
+    tokenizer = getattr(encoder, "tokenizer", None)
+    if tokenizer is None:
+        return [len(t.split()) for t in texts]
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+def encode_by_length(encoder, texts, batch_size=64):
+    # Encodes texts in batches of similar length so short messages aren't padded to the longest one in the
+    # batch, in input order. Both encoders sort by length themselves (SentenceTransformer by characters,
+    # OnnxEncoder by tokens), so this is just encode() with the batch size tuned for it
+    return encoder.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+
+SENTENCE_END_RE = re.compile(r'(?<=[.!?])\s+|\n+')
+# Higher is riskier; used to pool window predictions for long messages
+RISK_ORDER = {"no risk": 0, "moderate risk": 1, "high risk": 2}
+
+def split_windows(encoder, text, window_tokens=200, max_windows=8):
+    # Packs whole sentences into windows of at most window_tokens tokens (sentences longer than that are
+    # split by words). Returns at most max_windows windows and how many were dropped past the cap.
+    sentences = [s for s in SENTENCE_END_RE.split(text) if s.strip()]
+    pieces = []
+    for sentence, length in zip(sentences, token_lengths(encoder, sentences)):
+        if length <= window_tokens:
+            pieces.append((sentence, length))
+            continue
+        words = sentence.split()
+        tokens_per_word = length / max(1, len(words))
+        step = max(1, int(window_tokens / tokens_per_word))
+        for start in range(0, len(words), step):
+            chunk = words[start:start + step]
+            pieces.append((" ".join(chunk), min(window_tokens, int(len(chunk) * tokens_per_word) + 1)))
+
+    windows, current, current_length = [], [], 0
+    for piece, length in pieces:
+        if current and current_length + length > window_tokens:
+            windows.append(" ".join(current))
+            current, current_length = [], 0
+        current.append(piece)
+        current_length += length
+    if current:
+        windows.append(" ".join(current))
+    return windows[:max_windows], max(0, len(windows) - max_windows)
+
+def probability_margin(probabilities):
+    # Difference between the two most likely classes; small margins are the uncertain messages
+    top_two = np.sort(probabilities, axis=1)[:, -2:]
+    return top_two[:, 1] - top_two[:, 0]
+
+# Which stage labelled a message. A margin is the gap between the two best labels in that stage's own units,
+# so margins are only comparable (and thresholds only make sense) within one source:
+#   "svm"       SVC "ovr" scores, i.e. one-vs-one votes plus a confidence term below 1/3 (0 to about 2.7
+#               with three classes), for both head="sklearn" and head="compiled"
+#   "tfidf"     probability gap of the TF-IDF logistic regression (cascade first stage, backend="simple"), 0-1
+#   "template"  cosine-similarity gap between the nearest template and the best template of another label
+#   "exact"     always 1.0: the message is a training sentence and all of its training rows have this label
+SOURCES = ("svm", "tfidf", "template", "exact")
+
+class MessageScore(NamedTuple):
+    label: str
+    margin: float       # in the units of source, see SOURCES
+    probability: float  # NaN when the model isn't calibrated
+    template: str = ""  # known template the message matched, see modelTemplates.py
+    source: str = "svm"
+
+class Scores(NamedTuple):
+    labels: np.ndarray          # (n,) label strings
+    margins: np.ndarray         # (n,) float32 gap between the two highest class scores, see SOURCES
+    probabilities: np.ndarray   # (n,) float32 probability of the predicted label, NaN if uncalibrated
+    templates: np.ndarray = None    # (n,) matched template sentences, "" where the SVM was used
+    sources: np.ndarray = None      # (n,) stage that labelled each message, "svm" if None
+
+    @classmethod
+    def build(cls, labels, class_scores, probabilities=None, columns=None, source="svm"):
+        # class_scores / probabilities are (n, n_classes); columns are the predicted label's columns
+        labels = np.asarray(labels).astype(str)
+        margins = probability_margin(np.asarray(class_scores)).astype(np.float32)
+        if probabilities is None:
+            picked = np.full(len(labels), np.nan, dtype=np.float32)
+        else:
+            picked = np.asarray(probabilities)[np.arange(len(labels)), columns].astype(np.float32)
+        return cls(labels, margins, picked, None, np.full(len(labels), source))
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls(np.array([r.label for r in rows]).astype(str),
+                   np.array([r.margin for r in rows], dtype=np.float32),
+                   np.array([r.probability for r in rows], dtype=np.float32),
+                   np.array([r.template for r in rows]).astype(str),
+                   np.array([r.source for r in rows]).astype(str))
+
+    def rows(self):
+        templates = self.templates if self.templates is not None else [""] * len(self.labels)
+        sources = self.sources if self.sources is not None else ["svm"] * len(self.labels)
+        return [MessageScore(str(l), float(m), float(p), str(t), str(s))
+                for l, m, p, t, s in zip(self.labels, self.margins, self.probabilities, templates, sources)]
+
+class HeadScore(NamedTuple):
+    label: str
+    probability: float
+
+class MessageResult(NamedTuple):
+    risk: MessageScore
+    heads: dict         # extra head name -> HeadScore
+
+class ResultCache:
+    '''
+    Bounded classification cache (MessageScore rows) keyed by a hash of the normalized message text.
+    Entries are evicted least-recently-used once max_size is reached and expire after ttl seconds.
+    '''
+    def __init__(self, max_size=4096, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (value, time stored)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, stored = entry
+            if self.ttl is not None and time.monotonic() - stored > self.ttl:
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+# Predictor owned by each process pool worker, see _init_worker
+_worker_predictor = None
+
+def _init_worker(kwargs):
+    global _worker_predictor
+    _worker_predictor = Predictor(**kwargs)
+
+def _worker_svm_predict(text):
+    return _worker_predictor.svmPredict(text)
+
+def _worker_score(text):
+    return _worker_predictor.score(text)
+
+def _worker_classify(text):
+    return _worker_predictor.classify(text)
+
+def _worker_warm_up(texts, rounds):
+    return _worker_predictor.warmUp(texts, rounds)
 
 class Predictor:
-    def __init__(self):
-        self.svm_model = joblib.load("Models/SVM/svm_model_bert.pkl")
-        self.vectorizer = joblib.load("Models/tfidf_vectorizer.pkl")
-        self.le = joblib.load("Models/SVM/label_encoder.pkl")
-        self.bert_model = SentenceTransformer('all-MiniLM-L6-v2')
-
-        # self.BERTmodel = DistilBertForSequenceClassification.from_pretrained("DistilBERTModel")
-        # self.BERTtokenizer = DistilBertTokenizer.from_pretrained("DistilBERTModel")
-        # self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        # self.BERTmodel.to(self.device)
-        # self.BERTmodel.eval()
+    def __init__(self, executor="thread", max_workers=1, cache_size=4096, cache_ttl=600, encoder="torch", head="sklearn",
+                 cascade=False, cascade_margin=0.3, cascade_audit=0.0, backends=("svm",),
+                 bundle=None, long_text=False, window_tokens=200, max_windows=8,
+                 near_dup=False, near_dup_threshold=0.8, template_threshold=None, template_margin=0.05,
+                 exact_match=False):
+        # executor is "thread" or "process" and is only used by apredict, which keeps
+        # encoding + SVM prediction off the discord.py event loop
+        self.executor_kind = executor
+        self.max_workers = max_workers
+        self.executor = None
+        # a process pool breaks for good when a worker dies (e.g. can't load its models); it's replaced on
+        # the next call, but at most every pool_retry_after seconds
+        self.pool_retry_after = 30
+        self.pool_broken_since = None
+        # cache_size=0 disables the svmPredict result cache
+        self.cache = ResultCache(cache_size, cache_ttl) if cache_size else None
+        # settings process pool workers use to build their own Predictor
+        self.worker_kwargs = dict(cache_size=cache_size, cache_ttl=cache_ttl, encoder=encoder, head=head,
+                                  cascade=cascade, cascade_margin=cascade_margin, cascade_audit=cascade_audit,
+                                  backends=backends, bundle=bundle,
+                                  long_text=long_text, window_tokens=window_tokens, max_windows=max_windows,
+                                  near_dup=near_dup, near_dup_threshold=near_dup_threshold,
+                                  template_threshold=template_threshold, template_margin=template_margin,
+                                  exact_match=exact_match)
+        # near_dup=True reuses the result of a recent message with an estimated shingle Jaccard similarity of at
+        # least near_dup_threshold (MinHash-LSH, see modelNearDup.py) for messages that miss the exact cache;
+        # every reuse is logged for audit
+        self.near_dup = NearDuplicateIndex(near_dup_threshold, max(cache_size, 1024), cache_ttl) if near_dup else None
+
+        # Each backend ("simple" TF-IDF, "svm" MiniLM + SVM, "bert" DistilBERT) imports and loads its
+        # models the first time it's used; the ones listed in backends are loaded up front instead.
+        # head="compiled" classifies embeddings with the numpy export from modelHead.py, so the sklearn
+        # pickles are only loaded if simplePredict is used
+        self.encoder_backend = encoder
+        self.head_kind = head
+        self.load_lock = threading.Lock()
+        self.head = self.bert_model = self.projection = None
+        self.svm_model = self.vectorizer = self.le = None
+        self.BERTmodel = self.BERTtokenizer = self.device = None
+        # bundle is a directory built by modelBundle.py; its memory-mapped arrays replace the pickles
+        self.bundle = load_bundle(bundle) if bundle else None
+
+        # cascade=True scores every message with the TF-IDF model from modelTrainCascade.py first and
+        # only sends messages with a probability margin below cascade_margin to MiniLM + SVM.
+        # cascade_audit is the fraction of confident messages also run through the SVM to measure disagreement.
+        self.cascade = cascade
+        self.cascade_margin = cascade_margin
+        self.cascade_audit = cascade_audit
+        self.cascade_model = None
+        self.stats_lock = threading.Lock()
+        self.cascade_counts = dict(messages=0, escalated=0, escalated_disagree=0, audited=0, audited_disagree=0)
+        if cascade and self.bundle is not None and not self.bundle.has("cascade"):
+            raise ValueError("cascade needs a bundle built with a cascade model (see modelTrainCascade.py)")
+
+        # long_text=True splits messages longer than window_tokens tokens into at most max_windows sentence
+        # windows instead of letting MiniLM truncate them; all windows are encoded in one batch and the
+        # message gets the riskiest window's result
+        self.long_text = long_text
+        self.window_tokens = window_tokens
+        self.max_windows = max_windows
+        self.long_text_counts = dict(messages=0, windows=0, dropped_windows=0)
+
+        # template_threshold labels messages whose embedding has at least that cosine similarity to a known
+        # template (the bundle's template index, see modelTemplates.py) with the template's label instead of
+        # running the SVM, as long as no template of another label is within template_margin of it
+        self.template_threshold = template_threshold
+        self.template_margin = template_margin
+        self.templates = None
+        if template_threshold is not None:
+            if self.bundle is None or not self.bundle.has("templates"):
+                raise ValueError("template_threshold needs a bundle built with --templates")
+            self.templates = TemplateIndex.from_arrays(self.bundle.group("templates"))
+        self.template_counts = dict(messages=0, matched=0)
+
+        # exact_match=True labels messages that repeat a training sentence from the bundle's exact-match
+        # table (see modelExactMatch.py) before anything is encoded
+        self.exact = None
+        if exact_match:
+            if self.bundle is None or not self.bundle.has("exact"):
+                raise ValueError("exact_match needs a bundle built with --train-data")
+            self.exact = ExactMatchTable.from_arrays(self.bundle.group("exact"))
+        self.exact_counts = dict(messages=0, matched=0)
+
+        # extra linear heads stored in the bundle (e.g. report categories, see modelTrainHeads.py), used by classify()
+        self.extra_heads = {}
+        if self.bundle is not None:
+            for name in self.bundle.meta.get("heads", []):
+                self.extra_heads[name] = LinearHead.from_arrays(self.bundle.group("heads." + name))
+
+        # with a process pool every worker loads its own models, so this process doesn't need a copy
+        loaders = {"simple": self._loadSimple, "svm": self._loadSvm, "bert": self._loadBert}
+        for backend in (backends if executor != "process" else ()):
+            loaders[backend]()
+
+    def _loadSklearnModels(self):
+        with self.load_lock:
+            if self.svm_model is None:
+                svm_model = joblib.load("Models/SVM/svm_model_bert.pkl")
+                # the pickle may be the GridSearchCV from modelTrainSVMBulk.py rather than the SVC it picked
+                self.svm_model = getattr(svm_model, "best_estimator_", svm_model)
+                self.vectorizer = joblib.load("Models/tfidf_vectorizer.pkl")
+                self.le = joblib.load("Models/SVM/label_encoder.pkl")
+
+    def _loadTfidf(self):
+        if self.vectorizer is not None:
+            return
+        if self.bundle is not None:
+            self.vectorizer = tfidf_from_bundle(self.bundle)
+        else:
+            self.vectorizer = joblib.load("Models/tfidf_vectorizer.pkl")
+
+    def _loadCascade(self):
+        if self.cascade_model is not None:
+            return
+        self._loadTfidf()
+        if self.bundle is not None:
+            self.cascade_model = cascade_from_bundle(self.bundle)
+        else:
+            self.cascade_model = joblib.load(CASCADE_MODEL_PATH)
+
+    def _loadSimple(self):
+        # The TF-IDF classifier is the cascade's logistic regression (modelTrainCascade.py); svm_model_bert.pkl
+        # was trained on MiniLM embeddings and can't take TF-IDF features
+        self._loadCascade()
+        with self.load_lock:
+            if self.le is None and self.head is None and self.bundle is None:
+                self.le = joblib.load("Models/SVM/label_encoder.pkl")
+
+    def _loadSvm(self):
+        if self.bert_model is not None:
+            return
+        if self.bundle is not None:
+            self.head = CompiledHead.from_arrays(self.bundle.group("head"))
+            # SVMs trained on projected embeddings (see modelTrainSVMBulk.py) ship their projection in the bundle
+            if self.bundle.has("projection"):
+                self.projection = Projection.from_arrays(self.bundle.group("projection"))
+        elif self.head_kind == "compiled":
+            self.head = CompiledHead.load(HEAD_PATH)
+        else:
+            self._loadSklearnModels()
+        if self.cascade:
+            self._loadCascade()
+        with self.load_lock:
+            if self.bert_model is None:
+                self.bert_model = load_encoder(self.encoder_backend)
+
+    def _loadBert(self):
+        with self.load_lock:
+            if self.BERTmodel is not None:
+                return
+            import torch
+            from transformers import DistilBertTokenizer, DistilBertForSequenceClassification
+            self.BERTtokenizer = DistilBertTokenizer.from_pretrained("DistilBERTModel")
+            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            self.BERTmodel = DistilBertForSequenceClassification.from_pretrained("DistilBERTModel")
+            self.BERTmodel.to(self.device)
+            self.BERTmodel.eval()
+        if self.le is None and self.head is None and self.bundle is None:
+            self.le = joblib.load("Models/SVM/label_encoder.pkl")
 
     def simplePredict(self, text):
+        self._loadSimple()
         if not isinstance(text, list):
             text = [text]
-        X_new = self.vectorizer.transform(text)
-        y_pred = self.svm_model.predict(X_new)
-        predicted_labels = self.le.inverse_transform(y_pred)
-        return(predicted_labels)
+        probabilities = self.cascade_model.predict_proba(self.vectorizer.transform(text))
+        return self._labelNames()[self.cascade_model.classes_[np.argmax(probabilities, axis=1)]]
 
     def svmPredict(self,text):
+        return self.score(text).labels
+
+    def score(self, text, backend="svm"):
+        '''
+        Labels, decision margins and (for calibrated models) probabilities for a batch of messages from a
+        single embedding pass, as a Scores tuple of numpy arrays. The margin is the gap between the two
+        highest class scores, in the units of the stage that labelled the message (Scores.sources, see
+        SOURCES); probability is the predicted label's probability, NaN if uncalibrated.
+        backend="svm" goes through the result cache and the cascade; backend="simple" scores with TF-IDF only.
+        '''
+        if not isinstance(text, list):
+            text = [text]
+        if backend == "simple":
+            return self._simpleScore(text)
+        if backend != "svm":
+            raise ValueError(f"Unknown backend: {backend}")
+        self._loadSvm()
+        classify = self._cascadeScore if self.cascade else self._svmScore
+        if self.cache is None and self.near_dup is None and self.exact is None:
+            return classify(text)
+
+        # Only encode the messages that aren't already cached
+        keys = [text_key(t) for t in text] if self.cache is not None or self.exact is not None else None
+        if self.cache is not None:
+            rows = [self.cache.get(key) for key in keys]
+        else:
+            rows = [None] * len(text)
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if self.exact is not None and missing:
+            missing = self._exactLookup(text, keys, missing, rows)
+        if self.near_dup is not None and missing:
+            missing = self._nearDupLookup(text, missing, rows)
+        if missing:
+            scored = classify([text[i] for i in missing])
+            for i, row in zip(missing, scored.rows()):
+                rows[i] = row
+                if self.cache is not None:
+                    self.cache.put(keys[i], row)
+                if self.near_dup is not None:
+                    self.near_dup.put(normalize_text(text[i]), row)
+        return Scores.from_rows(rows)
+
+    def _exactLookup(self, text, keys, missing, rows):
+        # Fills rows for training sentences, returns the indices still to classify. A training sentence
+        # gets margin 1.0: all of its training rows have the same label. template stays empty, the
+        # row is marked by its "exact" source
+        codes = self.exact.lookup(hash_keys([keys[i] for i in missing]))
+        remaining = []
+        for i, code in zip(missing, codes):
+            if code < 0:
+                remaining.append(i)
+            else:
+                rows[i] = MessageScore(str(self.exact.labels[code]), 1.0, float("nan"), "", "exact")
+        with self.stats_lock:
+            self.exact_counts["messages"] += len(missing)
+            self.exact_counts["matched"] += len(missing) - len(remaining)
+        return remaining
+
+    def _nearDupLookup(self, text, missing, rows):
+        # Fills rows from near-duplicates of recent messages, returns the indices still to classify
+        remaining = []
+        for i in missing:
+            normalized = normalize_text(text[i])
+            match = self.near_dup.get(normalized)
+            if match is None:
+                remaining.append(i)
+                continue
+            rows[i], similarity, matched = match
+            logger.info(f'Near-duplicate reuse: {rows[i].label!r} (margin {rows[i].margin:.3f}) at similarity {similarity:.2f} '
+                        f'for {normalized[:80]!r}, matched {matched[:80]!r}')
+        return remaining
+
+    def classify(self, text):
+        '''
+        Risk score plus the prediction of every extra head for a batch of messages, as one MessageResult per
+        message, all from a single encoder pass. Unlike score(), nothing comes from the cache, the cascade or
+        the exact-match table, since the extra heads need the embedding anyway.
+        '''
         if not isinstance(text, list):
             text = [text]
-        sentence_embeddings = self.bert_model.encode(text, convert_to_numpy=True)
-        predictions = self.svm_model.predict(sentence_embeddings)
-        predicted_labels = self.le.inverse_transform(predictions)
-        return predicted_labels
+        self._loadSvm()
+        embeddings = encode_by_length(self.bert_model, text)
+        risk = self._scoreEmbeddings(embeddings).rows()
+        head_scores = {}
+        for name, head in self.extra_heads.items():
+            probabilities = head.probabilities(embeddings)
+            columns = np.argmax(probabilities, axis=1)
+            head_scores[name] = [HeadScore(str(head.labels[c]), float(p[c])) for c, p in zip(columns, probabilities)]
+        return [MessageResult(row, {name: scores[i] for name, scores in head_scores.items()})
+                for i, row in enumerate(risk)]
+
+    def _svmScore(self, text):
+        if self.long_text:
+            return self._longTextScore(text)
+        return self._scoreEmbeddings(encode_by_length(self.bert_model, text))
+
+    def _longTextScore(self, text):
+        # every token covers at least one character, so only messages longer than window_tokens characters
+        # can need splitting and only those are tokenized here
+        long_messages = [i for i, message in enumerate(text) if len(message) > self.window_tokens]
+        lengths = dict(zip(long_messages, token_lengths(self.bert_model, [text[i] for i in long_messages])
+                                          if long_messages else []))
+        windows, owners = [], []
+        for i, message in enumerate(text):
+            if lengths.get(i, 0) <= self.window_tokens:
+                windows.append(message)
+                owners.append(i)
+                continue
+            split, dropped = split_windows(self.bert_model, message, self.window_tokens, self.max_windows)
+            windows.extend(split)
+            owners.extend([i] * len(split))
+            with self.stats_lock:
+                self.long_text_counts["messages"] += 1
+                self.long_text_counts["windows"] += len(split)
+                self.long_text_counts["dropped_windows"] += dropped
+
+        # max-risk pooling: each message takes its riskiest window, the larger margin breaking ties
+        scored = self._scoreEmbeddings(encode_by_length(self.bert_model, windows)).rows()
+        pooled = [None] * len(text)
+        for owner, row in zip(owners, scored):
+            best = pooled[owner]
+            if best is None or (RISK_ORDER.get(row.label, 0), row.margin) > (RISK_ORDER.get(best.label, 0), best.margin):
+                pooled[owner] = row
+        return Scores.from_rows(pooled)
+
+    def _scoreEmbeddings(self, sentence_embeddings):
+        if self.templates is None:
+            return self._headScore(sentence_embeddings)
+        nearest, similarity, label_scores = self.templates.match(sentence_embeddings)
+        margins = probability_margin(label_scores)
+        matched = (similarity >= self.template_threshold) & (margins >= self.template_margin)
+        with self.stats_lock:
+            self.template_counts["messages"] += len(matched)
+            self.template_counts["matched"] += int(matched.sum())
+        if matched.all():
+            rest = None
+        else:
+            rest = iter(self._headScore(sentence_embeddings[~matched]).rows())
+        # template matches have no probability; their margin is the similarity gap to the best other label
+        return Scores.from_rows([MessageScore(str(self.templates.label_of(nearest[i])), float(margins[i]), float("nan"),
+                                              str(self.templates.texts[nearest[i]]), "template") if hit else next(rest)
+                                 for i, hit in enumerate(matched)])
+
+    def _headScore(self, sentence_embeddings):
+        if self.projection is not None:
+            sentence_embeddings = self.projection.transform(sentence_embeddings)
+        if self.head is not None:
+            classes, class_scores, probabilities = self.head.score(sentence_embeddings)
+        else:
+            # one kernel evaluation for class and scores; a calibrated SVC needs a second one for predict_proba,
+            # head="compiled" gets its probabilities from the first
+            classes, class_scores = self._svcScores(sentence_embeddings)
+            probabilities = self.svm_model.predict_proba(sentence_embeddings) if hasattr(self.svm_model, "predict_proba") else None
+        return Scores.build(self._labelNames()[classes], class_scores, probabilities, classes)
 
         # Show results
         # for sentence, label in zip(sentences, predicted_labels):
         #     print(f"Sentence: {sentence}\nPredicted Label: {label}\n")
 
+    def _svcScores(self, X):
+        # svm_model.predict() classes and "ovr" decision scores from one decision_function() call.
+        # Binary scores are positive for classes_[1]. The "ovr" scores of a multi-class SVC are its one-vs-one
+        # votes plus a confidence term below 1/3, so rounding them gives the votes predict() uses (lowest class
+        # wins ties unless break_ties is set); "ovo" pair columns are turned into the same scores first
+        model = self.svm_model
+        class_scores = model.decision_function(X)
+        if class_scores.ndim == 1:
+            return model.classes_[(class_scores > 0).astype(int)], class_scores
+        if model.decision_function_shape == "ovo":
+            class_scores = self._ovoToOvr(class_scores, len(model.classes_))
+        elif model.break_ties:
+            return model.classes_[np.argmax(class_scores, axis=1)], class_scores
+        return model.classes_[np.argmax(np.round(class_scores), axis=1)], class_scores
+
+    @staticmethod
+    def _ovoToOvr(dec, n_classes):
+        # Pair columns come in the order (0, 1), (0, 2), ..., (1, 2), ...; a pair's vote goes to its first class
+        # when the value is positive, as in libsvm. Same transform as CompiledHead._ovr_scores
+        votes = np.zeros((len(dec), n_classes))
+        confidences = np.zeros((len(dec), n_classes))
+        for p, (i, j) in enumerate(itertools.combinations(range(n_classes), 2)):
+            votes[:, i] += dec[:, p] > 0
+            votes[:, j] += dec[:, p] <= 0
+            confidences[:, i] += dec[:, p]
+            confidences[:, j] -= dec[:, p]
+        return votes + confidences / (3 * (np.abs(confidences) + 1))
+
+    def _simpleScore(self, text):
+        self._loadSimple()
+        probabilities = self.cascade_model.predict_proba(self.vectorizer.transform(text))
+        columns = np.argmax(probabilities, axis=1)
+        return Scores.build(self._labelNames()[self.cascade_model.classes_[columns]], probabilities, probabilities, columns,
+                            "tfidf")
+
+    def _labelNames(self):
+        if self.bundle is not None:
+            return np.array(self.bundle.meta["labels"])
+        return self.head.labels if self.head is not None else self.le.classes_
+
+    def _cascadeScore(self, text):
+        probabilities = self.cascade_model.predict_proba(self.vectorizer.transform(text))
+        columns = np.argmax(probabilities, axis=1)
+        first = Scores.build(self._labelNames()[self.cascade_model.classes_[columns]], probabilities, probabilities, columns,
+                             "tfidf")
+        uncertain = first.margins < self.cascade_margin
+        audit = ~uncertain & (np.random.random(len(text)) < self.cascade_audit)
+
+        rows = list(first.rows())
+        second_stage = np.flatnonzero(uncertain | audit)
+        if len(second_stage):
+            second = self._svmScore([text[i] for i in second_stage])
+            disagree = first.labels[second_stage] != second.labels
+            escalated = uncertain[second_stage]
+            for i, row, keep in zip(second_stage, second.rows(), escalated):
+                if keep:
+                    rows[i] = row
+        else:
+            disagree = escalated = np.zeros(0, dtype=bool)
+
+        with self.stats_lock:
+            counts = self.cascade_counts
+            before = counts["messages"]
+            counts["messages"] += len(text)
+            counts["escalated"] += int(uncertain.sum())
+            counts["escalated_disagree"] += int((disagree & escalated).sum())
+            counts["audited"] += int(audit.sum())
+            counts["audited_disagree"] += int((disagree & ~escalated).sum())
+            if counts["messages"] // 1000 > before // 1000:
+                logger.info(f'Cascade stats: {self.cascadeStats()}')
+        return Scores.from_rows(rows)
+
+    def cascadeStats(self):
+        counts = self.cascade_counts
+        return {
+            **counts,
+            # fraction of messages that needed the encoder
+            "escalation_rate": counts["escalated"] / counts["messages"] if counts["messages"] else 0.0,
+            # how often the TF-IDF model was overruled on uncertain messages
+            "escalated_disagreement_rate": counts["escalated_disagree"] / counts["escalated"] if counts["escalated"] else 0.0,
+            # how often the TF-IDF label we kept would have been changed by the SVM
+            "audited_disagreement_rate": counts["audited_disagree"] / counts["audited"] if counts["audited"] else 0.0,
+        }
+
+    def _get_executor(self):
+        if self.executor is None:
+            if self.executor_kind == "process":
+                # every worker loads its own copy of the models once at startup. Workers are spawned rather than
+                # forked: forking after torch has started its threads can deadlock the child
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker,
+                                                    initargs=(self.worker_kwargs,),
+                                                    mp_context=multiprocessing.get_context("spawn"))
+            elif self.executor_kind == "thread":
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="predictor")
+            else:
+                raise ValueError(f"Unknown executor type: {self.executor_kind}")
+        return self.executor
+
+    async def _inPool(self, fn, *args):
+        if self.executor is None and self.pool_broken_since is not None \
+                and time.monotonic() - self.pool_broken_since < self.pool_retry_after:
+            raise BrokenProcessPool(f"The predictor process pool broke less than {self.pool_retry_after}s ago")
+        executor = self._get_executor()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            if self.executor is executor:
+                logger.warning("The predictor process pool broke, it's replaced on the next call")
+                executor.shutdown(wait=False)
+                self.executor = None
+                self.pool_broken_since = time.monotonic()
+            raise
+
+    async def apredict(self, text):
+        # Same result as svmPredict, but awaits the work in a pool so heartbeats and
+        # other events keep being handled while the model runs
+        return await self._inPool(_worker_svm_predict if self.executor_kind == "process" else self.svmPredict, text)
+
+    async def ascore(self, text):
+        # score() in the pool, see apredict
+        return await self._inPool(_worker_score if self.executor_kind == "process" else self.score, text)
+
+    async def aclassify(self, text):
+        # classify() in the pool, see apredict
+        return await self._inPool(_worker_classify if self.executor_kind == "process" else self.classify, text)
+
+    def warmUp(self, texts=WARMUP_SENTENCES, rounds=5):
+        # Runs a few uncached batches so first-call costs are paid before serving; returns the latencies
+        self._loadSvm()
+        timings = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            self._svmScore(list(texts))
+            timings.append(time.perf_counter() - start)
+        return {"messages": len(texts), "rounds": rounds, "first_ms": 1000 * timings[0],
+                "mean_ms": 1000 * sum(timings[1:]) / max(1, rounds - 1), "max_ms": 1000 * max(timings)}
+
+    async def awarmUp(self, texts=WARMUP_SENTENCES, rounds=5):
+        # warmUp() where predictions will actually run. With a process pool that's in the workers, which load their
+        # models when the pool starts; one warm-up per worker is submitted at once, and since each one has to
+        # wait for its worker's models to load, they end up spread over the pool. Returns the slowest worker's
+        # first call and mean, plus the number of warm-ups that ran
+        if self.executor_kind != "process":
+            result = await self._inPool(self.warmUp, texts, rounds)
+            return {**result, "workers": 1}
+        results = await asyncio.gather(*(self._inPool(_worker_warm_up, texts, rounds) for _ in range(self.max_workers)))
+        return {"messages": len(texts), "rounds": rounds, "workers": len(results),
+                "first_ms": max(r["first_ms"] for r in results), "mean_ms": max(r["mean_ms"] for r in results),
+                "max_ms": max(r["max_ms"] for r in results)}
+
+    def close(self):
+        # Queued and running predictions still finish; the pool just stops taking new work
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
     def predict(self, text):
+        import torch
+        self._loadBert()
         inputs = self.BERTtokenizer(text, return_tensors="pt", padding=True, truncation=True)
         inputs = {k: v.to(self.device) for k, v in inputs.items()}
         
         with torch.no_grad():
             outputs = self.BERTmodel(**inputs)
             predicted_class_id = torch.argmax(outputs.logits, dim=1).item()
-            predicted_label = self.le.inverse_transform([predicted_class_id])[0]
+            predicted_label = self._labelNames()[predicted_class_id]
             return predicted_label
                             
 def test():
@@ -59,6 +794,26 @@ def test():
     print(predicted_labels)
 
 def main():
+    parser = argparse.ArgumentParser(description="Classify messages interactively, or a whole file with --input")
+    parser.add_argument("--input", help="CSV or JSONL file of messages to classify")
+    parser.add_argument("--output", help="CSV or JSONL file for the results (default: <input>.labels.jsonl)")
+    parser.add_argument("--text-field", default="sentence")
+    parser.add_argument("--id-field", default=None, help="input field copied to the output next to each result")
+    parser.add_argument("--backend", choices=["svm", "simple"], default="svm")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--resume", action="store_true", help="continue after the last record in --output")
+    parser.add_argument("--start", type=int, default=0, help="input record offset to start from")
+    parser.add_argument("--bundle", default=None)
+    args = parser.parse_args()
+
+    if args.input:
+        from modelBulk import classify_file
+        predictor = Predictor(backends=(args.backend,), cache_size=0, bundle=args.bundle)
+        classify_file(predictor, args.input, args.output or args.input + ".labels.jsonl", backend=args.backend,
+                      batch_size=args.batch_size, text_field=args.text_field, id_field=args.id_field,
+                      start=args.start, resume=args.resume)
+        return
+
     predictor = Predictor()
     while True:
         text = input("Enter a sentence or enter to quit: ")
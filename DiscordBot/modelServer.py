@@ -0,0 +1,253 @@
+# Standalone inference server so several bot processes can share one set of models.
+# The parent loads the Predictor once and forks worker processes, which share the model pages
+# copy-on-write (and the memory-mapped arrays when a bundle is used). Each worker batches
+# requests from all of its clients through a BatchPredictor.
+# Run from the DiscordBot directory:
+#   python modelServer.py --socket /tmp/modbot-predictor.sock --workers 2 --bundle Models/bundle
+#
+# Protocol: every frame is a 4 byte big-endian length followed by the body.
+#   request body:  u32 count, then count x (u32 length, utf-8 text)
+#   response body: u8 status, then for status 0: u32 count, count x (u16 length, utf-8 label,
+#                  f32 margin, f32 probability, u16 length, utf-8 matched template or empty,
+#                  u8 index of the row's source in modelPredict.SOURCES)
+#                  for status 1: utf-8 error message
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import socket
+import struct
+import time
+from modelBatcher import BatchPredictor
+from modelPredict import Predictor, MessageScore, Scores, SOURCES
+
+logger = logging.getLogger('discord')
+
+DEFAULT_SOCKET = "/tmp/modbot-predictor.sock"
+MAX_FRAME = 16 * 1024 * 1024
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+
+def encode_request(texts):
+    parts = [struct.pack(">I", len(texts))]
+    for text in texts:
+        data = text.encode("utf-8")
+        parts.append(struct.pack(">I", len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def decode_request(body):
+    (count,), offset = struct.unpack_from(">I", body), 4
+    texts = []
+    for _ in range(count):
+        (length,) = struct.unpack_from(">I", body, offset)
+        offset += 4
+        texts.append(body[offset:offset + length].decode("utf-8"))
+        offset += length
+    return texts
+
+
+def encode_response(rows):
+    parts = [struct.pack(">BI", STATUS_OK, len(rows))]
+    for row in rows:
+        data = row.label.encode("utf-8")
+        parts.append(struct.pack(">H", len(data)))
+        parts.append(data)
+        template = row.template.encode("utf-8")
+        parts.append(struct.pack(">ffH", row.margin, row.probability, len(template)))
+        parts.append(template)
+        parts.append(struct.pack(">B", SOURCES.index(row.source)))
+    return b"".join(parts)
+
+
+def decode_response(body):
+    if body[0] != STATUS_OK:
+        raise RuntimeError(f"Inference server error: {body[1:].decode('utf-8', 'replace')}")
+    (count,), offset = struct.unpack_from(">I", body, 1), 5
+    rows = []
+    for _ in range(count):
+        (length,) = struct.unpack_from(">H", body, offset)
+        offset += 2
+        label = body[offset:offset + length].decode("utf-8")
+        margin, probability, template_length = struct.unpack_from(">ffH", body, offset + length)
+        offset += length + 10
+        template = body[offset:offset + template_length].decode("utf-8")
+        offset += template_length
+        source = SOURCES[body[offset]]
+        offset += 1
+        rows.append(MessageScore(label, margin, probability, template, source))
+    return Scores.from_rows(rows)
+
+
+async def read_frame(reader):
+    (length,) = struct.unpack(">I", await reader.readexactly(4))
+    if length > MAX_FRAME:
+        raise ValueError(f"Frame of {length} bytes is larger than {MAX_FRAME}")
+    return await reader.readexactly(length)
+
+
+def write_frame(writer, body):
+    writer.write(struct.pack(">I", len(body)) + body)
+
+
+class RemotePredictor:
+    '''
+    Client for modelServer.py with the same apredict() and ascore() as Predictor, so it can sit behind a BatchPredictor.
+    If the socket can't be reached, requests go to a local Predictor built by make_local (created on first
+    use), and the socket is tried again after retry_after seconds.
+    '''
+    def __init__(self, path=DEFAULT_SOCKET, make_local=None, retry_after=30, timeout=10):
+        self.path = path
+        self.make_local = make_local
+        self.retry_after = retry_after
+        self.timeout = timeout
+        self.reader = self.writer = None
+        self.lock = asyncio.Lock()
+        self.local = None
+        self.down_since = None
+
+    async def _request(self, texts):
+        async with self.lock:
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+            try:
+                write_frame(self.writer, encode_request(texts))
+                await self.writer.drain()
+                return decode_response(await asyncio.wait_for(read_frame(self.reader), self.timeout))
+            except BaseException:
+                self.writer.close()
+                self.reader = self.writer = None
+                raise
+
+    async def apredict(self, text):
+        return list((await self.ascore(text)).labels)
+
+    async def ascore(self, text):
+        texts = text if isinstance(text, list) else [text]
+        if self.down_since is None or time.monotonic() - self.down_since > self.retry_after:
+            try:
+                scores = await self._request(texts)
+                if self.down_since is not None:
+                    logger.info(f'Inference server at {self.path} is back')
+                self.down_since = None
+                return scores
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                if self.make_local is None:
+                    raise
+                logger.warning(f'Inference server at {self.path} unavailable ({e!r}), using local model')
+                self.down_since = time.monotonic()
+        if self.local is None:
+            self.local = await asyncio.to_thread(self.make_local)
+        return await self.local.ascore(texts)
+
+
+async def serve_worker(sock, predictor, max_batch_size, max_wait):
+    batcher = BatchPredictor(predictor, max_batch_size=max_batch_size, max_wait=max_wait)
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                texts = decode_request(await read_frame(reader))
+                try:
+                    rows = await asyncio.gather(*(batcher.predict(t) for t in texts))
+                    write_frame(writer, encode_response(rows))
+                except Exception as e:
+                    logger.exception('Inference failed')
+                    write_frame(writer, bytes([STATUS_ERROR]) + str(e).encode("utf-8"))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle, sock=sock)
+    async with server:
+        await server.serve_forever()
+
+
+def run_worker(sock, predictor, args):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # warm up in the child; running the model in the parent before forking can deadlock torch's thread pools
+    predictor.svmPredict(["warm up"])
+    asyncio.run(serve_worker(sock, predictor, args.max_batch_size, args.max_wait_ms / 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared inference server for ModBot")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--bundle", default=None)
+    parser.add_argument("--encoder", default="torch")
+    parser.add_argument("--head", default="sklearn")
+    # same options as the bot's PREDICTOR_* environment variables, which don't apply when it uses this server
+    parser.add_argument("--cascade", action="store_true")
+    parser.add_argument("--cascade-margin", type=float, default=0.3)
+    parser.add_argument("--cascade-audit", type=float, default=0.0)
+    parser.add_argument("--long-text", action="store_true")
+    parser.add_argument("--max-windows", type=int, default=8)
+    parser.add_argument("--near-dup", action="store_true")
+    parser.add_argument("--near-dup-threshold", type=float, default=0.8)
+    parser.add_argument("--template-threshold", type=float, default=None)
+    parser.add_argument("--exact-match", action="store_true")
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(process)d: %(message)s')
+
+    start = time.perf_counter()
+    predictor = Predictor(encoder=args.encoder, head=args.head, bundle=args.bundle,
+                          cascade=args.cascade, cascade_margin=args.cascade_margin, cascade_audit=args.cascade_audit,
+                          long_text=args.long_text, max_windows=args.max_windows,
+                          near_dup=args.near_dup, near_dup_threshold=args.near_dup_threshold,
+                          template_threshold=args.template_threshold, exact_match=args.exact_match)
+    logger.info(f'Models loaded in {time.perf_counter() - start:.1f}s')
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(args.socket)
+    sock.listen(128)
+
+    children = set()
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(sock, predictor, args)
+            except BaseException:
+                logger.exception('Worker failed')
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def shutdown(signum, frame):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        raise SystemExit(0)
+
+    for _ in range(args.workers):
+        spawn()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    logger.info(f'Serving on {args.socket} with {args.workers} workers')
+
+    # restart workers that die
+    while True:
+        pid, status = os.wait()
+        children.discard(pid)
+        logger.warning(f'Worker {pid} exited with status {status}, restarting')
+        time.sleep(1)
+        spawn()
+
+
+if __name__ == "__main__":
+    main()
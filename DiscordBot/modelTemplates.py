@@ -0,0 +1,92 @@
+# Embedding index of the canonical sentences from generate_dataset.py, used by Predictor(template_threshold=...)
+# to label messages that are close paraphrases of a known template without running the SVM.
+# The index is built when a model bundle is created (modelBundle.py --templates ...) and loaded from it
+# memory-mapped. Templates are read with ast instead of importing the script, which writes a CSV on import.
+
+import ast
+import numpy as np
+
+TEMPLATE_SCRIPT = "FinalSubmissionExtraFiles/generate_dataset.py"
+# list name in generate_dataset.py -> label of its sentences
+TEMPLATE_LISTS = {
+    "high_risk_templates": "high risk",
+    "moderate_risk_templates": "moderate risk",
+    "no_risk_templates": "no risk",
+    "neutral_no_risk_sentences": "no risk",
+}
+
+
+def read_templates(path=TEMPLATE_SCRIPT):
+    # (texts, labels) for every sentence in the TEMPLATE_LISTS lists, first occurrence wins
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    texts, labels, seen, found = [], [], set(), set()
+    for node in tree.body:
+        if not (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)):
+            continue
+        label = TEMPLATE_LISTS.get(node.targets[0].id)
+        if label is None:
+            continue
+        found.add(node.targets[0].id)
+        for text in ast.literal_eval(node.value):
+            if text.strip().lower() not in seen:
+                seen.add(text.strip().lower())
+                texts.append(text)
+                labels.append(label)
+    if found != set(TEMPLATE_LISTS):
+        raise ValueError(f"{path} has no {', '.join(sorted(set(TEMPLATE_LISTS) - found))}")
+    return texts, labels
+
+
+def normalize_rows(X):
+    X = np.asarray(X, dtype=np.float32)
+    return X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+
+
+class TemplateIndex:
+    '''
+    Unit-length template embeddings sorted by label, so the best similarity per label is one
+    np.maximum.reduceat over the similarity matrix.
+    '''
+    def __init__(self, embeddings, texts, labels, starts):
+        self.embeddings = embeddings    # (n_templates, d) float32, rows have unit length
+        self.texts = texts              # (n_templates,) template sentences
+        self.labels = labels            # (n_classes,) label of each group
+        self.starts = starts            # (n_classes,) first row of each label's group
+
+    def similarities(self, X):
+        return normalize_rows(X) @ self.embeddings.T
+
+    def search(self, X, k=5):
+        # Indices and cosine similarities of the k nearest templates per row, most similar first
+        sims = self.similarities(X)
+        k = min(k, sims.shape[1])
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        top_sims = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(-top_sims, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_sims, order, axis=1)
+
+    def match(self, X):
+        # Nearest template per row, its similarity and the best similarity for every label
+        sims = self.similarities(X)
+        nearest = np.argmax(sims, axis=1)
+        return nearest, sims[np.arange(len(sims)), nearest], np.maximum.reduceat(sims, self.starts, axis=1)
+
+    def label_of(self, index):
+        return self.labels[np.searchsorted(self.starts, index, side="right") - 1]
+
+    def to_arrays(self):
+        return {"embeddings": self.embeddings, "texts": self.texts, "labels": self.labels, "starts": self.starts}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["embeddings"], arrays["texts"], arrays["labels"], arrays["starts"])
+
+
+def build_index(encoder, texts, labels, batch_size=64):
+    order = np.argsort(np.asarray(labels), kind="stable")
+    texts = np.asarray(texts)[order]
+    labels = np.asarray(labels)[order]
+    group_labels, starts = np.unique(labels, return_index=True)
+    embeddings = normalize_rows(encoder.encode(list(texts), batch_size=batch_size, convert_to_numpy=True))
+    return TemplateIndex(embeddings, texts, group_labels.astype(str), starts.astype(np.int64))
@@ -0,0 +1,37 @@
+# Trains the first (TF-IDF) stage of the Predictor cascade. Models/logistic_model.pkl was trained on a
+# different 144-feature vectorizer, so it can't be used with Models/tfidf_vectorizer.pkl; this fits a
+# logistic regression on the existing vectorizer and the same split as modelTrainSVMBulk.py
+# (modelPredict.train_test_sentences).
+# Run from the DiscordBot directory: python modelTrainCascade.py
+
+import joblib
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import classification_report
+from modelPredict import CASCADE_MODEL_PATH, probability_margin, train_test_sentences
+
+vectorizer = joblib.load("Models/tfidf_vectorizer.pkl")
+le = joblib.load("Models/SVM/label_encoder.pkl")
+
+X_train, X_test, labels_train, labels_test = train_test_sentences()
+y_train, y_test = le.transform(labels_train), le.transform(labels_test)
+
+model = LogisticRegression(C=10, max_iter=2000)
+model.fit(vectorizer.transform(X_train), y_train)
+joblib.dump(model, CASCADE_MODEL_PATH)
+
+probabilities = model.predict_proba(vectorizer.transform(X_test))
+y_pred = model.classes_[np.argmax(probabilities, axis=1)]
+print("Classification Report:\n")
+print(classification_report(y_test, y_pred, target_names=le.classes_))
+
+# Messages with a margin below the band go to MiniLM + SVM; the error rate on the rest is the most
+# accuracy the cascade can lose compared to running the SVM on everything
+margins = probability_margin(probabilities)
+high_risk = le.transform(["high risk"])[0]
+print("margin  escalated  stage-1 error on kept  missed high risk")
+for band in (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8):
+    kept = margins >= band
+    error = np.mean(y_pred[kept] != y_test[kept]) if kept.any() else 0.0
+    missed = np.sum(kept & (y_test == high_risk) & (y_pred != high_risk))
+    print(f"{band:6.2f}  {1 - kept.mean():9.2%}  {error:21.2%}  {missed:16d}")
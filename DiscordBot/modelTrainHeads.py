@@ -0,0 +1,50 @@
+# Trains an extra linear head on MiniLM sentence embeddings for Predictor.classify from a labeled CSV,
+# e.g. the report categories from report.py (Offensive Content / Imminent Danger / Criminal Activity).
+# Run from the DiscordBot directory:
+#   python modelTrainHeads.py --data reports.csv --label-field category --name category
+#   python modelBundle.py --head category=Models/heads/category.npz --out Models/bundle
+# The head is a logistic regression, so adding it to the bot costs one small matmul per message on top
+# of the embedding the risk SVM already needs.
+
+import argparse
+import os
+import pandas as pd
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import classification_report
+from sklearn.model_selection import train_test_split
+from modelHead import LinearHead
+from modelPredict import load_encoder, encode_by_length
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train an extra classifier head on sentence embeddings")
+    parser.add_argument("--data", required=True, help="CSV with a text column and a label column")
+    parser.add_argument("--text-field", default="sentence")
+    parser.add_argument("--label-field", required=True)
+    parser.add_argument("--name", required=True, help="head name, used as the key in Predictor.classify results")
+    parser.add_argument("--out", default=None, help="default: Models/heads/<name>.npz")
+    parser.add_argument("--C", type=float, default=1.0)
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.data, usecols=[args.text_field, args.label_field]).dropna()
+    X_train, X_test, y_train, y_test = train_test_split(
+        df[args.text_field].astype(str), df[args.label_field].astype(str), test_size=0.12,
+        stratify=df[args.label_field], random_state=42
+    )
+    encoder = load_encoder("torch")
+    model = LogisticRegression(C=args.C, max_iter=2000)
+    model.fit(encode_by_length(encoder, X_train.tolist()), y_train)
+
+    head = LinearHead.from_sklearn(model)
+    print("Classification Report:\n")
+    probabilities = head.probabilities(encode_by_length(encoder, X_test.tolist()))
+    print(classification_report(y_test, head.labels[probabilities.argmax(axis=1)]))
+
+    out = args.out or os.path.join("Models", "heads", args.name + ".npz")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    head.save(out)
+    print(f"Saved head {args.name!r} with labels {[str(label) for label in head.labels]} to {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,6 @@
 # useChatGPT for overall structure and debugging env errors and different sized array errors
 
-import pandas as pd
 import matplotlib.pyplot as plt
-from sklearn.model_selection import train_test_split
 from sklearn.svm import SVC
 from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import classification_report, confusion_matrix
@@ -11,38 +9,38 @@ from sklearn.model_selection import GridSearchCV
 from sentence_transformers import SentenceTransformer
 from numpy import unique
 from sklearn import metrics
-
-# Load your dataset
-df = pd.read_csv("FinalSubmissionExtraFiles/FinalData.csv", usecols=['sentence', 'label'])  # must be in DiscordBot directory
+import numpy as np
+from modelPredict import encode_by_length, train_test_sentences
+import time
+from sklearn.decomposition import PCA
+from sklearn.random_projection import GaussianRandomProjection
+from sklearn.metrics import f1_score
+from modelHead import compile_svm, Projection
+
+# Optional projection stage: fit a PCA or random projection on the training embeddings, retrain the SVM on
+# each size in PROJECTION_DIMS and compare accuracy, size and latency with the full 384-d model. The smallest
+# size within PROJECTION_MAX_F1_LOSS of the full model's macro F1 is saved; build a bundle from it with
+#   python modelBundle.py --svm Models/SVM/svm_model_proj.pkl --projection Models/SVM/projection.npz --out Models/bundle_proj
+PROJECTION = None  # "pca" or "random"
+PROJECTION_DIMS = [32, 64, 96, 128, 192]
+PROJECTION_MAX_F1_LOSS = 0.005
+
+# Load and split the dataset (must be in DiscordBot directory); rows with missing sentences are dropped after
+# the split. The other scripts evaluate on the same held-out rows through the same function
+X_train, X_test, labels_train, labels_test = train_test_sentences()
 
 # Encode labels
 le = LabelEncoder()
-df['label_encoded'] = le.fit_transform(df['label'])
-
-# Split the data
-X_train, X_test, y_train, y_test = train_test_split(
-    df['sentence'], df['label_encoded'], test_size=0.12, stratify=df['label_encoded'], random_state=42
-)
-
-# Drop rows with missing sentence data and realign labels
-train_df = pd.DataFrame({'sentence': X_train, 'label': y_train})
-train_df = train_df.dropna()
-
-X_train = train_df['sentence'].astype(str)
-y_train = train_df['label']
-
-test_df = pd.DataFrame({'sentence': X_test, 'label': y_test})
-test_df = test_df.dropna()
-
-X_test = test_df['sentence'].astype(str)
-y_test = test_df['label']
+le.fit(np.concatenate([labels_train, labels_test]))
+y_train = le.transform(labels_train)
+y_test = le.transform(labels_test)
 
 # Load BERT sentence embedding model
 bert_model = SentenceTransformer('all-MiniLM-L6-v2')
 
-# Convert sentences into embeddings
-X_train_embeddings = bert_model.encode(X_train.tolist(), convert_to_numpy=True)
-X_test_embeddings = bert_model.encode(X_test.tolist(), convert_to_numpy=True)
+# Convert sentences into embeddings, batching sentences of similar token length together
+X_train_embeddings = encode_by_length(bert_model, X_train)
+X_test_embeddings = encode_by_length(bert_model, X_test)
 
 
 # Train SVM on BERT embeddings
@@ -74,6 +72,47 @@ y_pred = svm_model.predict(X_test_embeddings)
 print("Classification Report:\n")
 print(classification_report(y_test, y_pred, target_names=le.classes_))
 
+def call_latency(predict, X, calls=200):
+    # mean ms for classifying one message at a time, like the bot does
+    start = time.perf_counter()
+    for i in range(calls):
+        predict(X[i % len(X)][None, :])
+    return (time.perf_counter() - start) / calls * 1000
+
+def head_size(head, projection=None):
+    arrays = list(head.to_arrays().values()) + (list(projection.to_arrays().values()) if projection else [])
+    return sum(a.nbytes for a in arrays) / 1e6
+
+if PROJECTION:
+    base_model = getattr(svm_model, "best_estimator_", svm_model)
+    full_head = compile_svm(base_model, le)
+    full_f1 = f1_score(y_test, y_pred, average='macro')
+    print(f"{PROJECTION} projection: dims  macro F1  support vectors  head MB  ms/call")
+    print(f"{X_train_embeddings.shape[1]:>22d}  {full_f1:8.4f}  {len(base_model.support_vectors_):15d}  "
+          f"{head_size(full_head):7.2f}  {call_latency(full_head.predict, X_test_embeddings):7.3f}")
+    chosen = None
+    for dims in PROJECTION_DIMS:
+        if PROJECTION == "pca":
+            projector = PCA(n_components=dims, random_state=42)
+        else:
+            projector = GaussianRandomProjection(n_components=dims, random_state=42)
+        projection = Projection.from_sklearn(projector.fit(X_train_embeddings))
+        reduced_model = SVC(**base_model.get_params()).fit(projection.transform(X_train_embeddings), y_train)
+        reduced_head = compile_svm(reduced_model, le)
+        f1 = f1_score(y_test, reduced_model.predict(projection.transform(X_test_embeddings)), average='macro')
+        latency = call_latency(lambda x: reduced_head.predict(projection.transform(x)), X_test_embeddings)
+        print(f"{dims:>22d}  {f1:8.4f}  {len(reduced_model.support_vectors_):15d}  "
+              f"{head_size(reduced_head, projection):7.2f}  {latency:7.3f}")
+        if chosen is None and full_f1 - f1 <= PROJECTION_MAX_F1_LOSS:
+            chosen = (dims, projection, reduced_model)
+    if chosen is None:
+        print(f"No projection size is within {PROJECTION_MAX_F1_LOSS} macro F1 of the full model, nothing saved")
+    else:
+        dims, projection, reduced_model = chosen
+        projection.save("Models/SVM/projection.npz")
+        joblib.dump(reduced_model, "Models/SVM/svm_model_proj.pkl")
+        print(f"Saved the {dims}-d projection to Models/SVM/projection.npz and its SVM to Models/SVM/svm_model_proj.pkl")
+
 print("Confusion Matrix:\n")
 confusion_matrix = metrics.confusion_matrix(y_test, y_pred)
 cm_display = metrics.ConfusionMatrixDisplay(confusion_matrix = confusion_matrix, display_labels = le.classes_)